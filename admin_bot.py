@@ -1,10 +1,12 @@
 # admin_bot.py
 import os
 import re
+import asyncio
 import uuid
-import json
-import base64
 import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 
@@ -15,18 +17,22 @@ from telegram.ext import (
     MessageHandler, CallbackQueryHandler, filters
 )
 
-from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 
-# Invite helper from the student bot (used after adding a student)
-from student_bot import invite_student_to_subject_groups
+# Student-bot helpers: invites after adding a student, bulk DMs, its Students cache and Subjects_Channels
+# rows, the Sheets executor that retries 429/5xx with backoff, and the shared credentials, per-thread
+# connections and column letters
+from student_bot import (
+    invite_student_to_subject_groups, send_to_many, invalidate_student_cache,
+    ensure_subject_channels_rows as ensure_subject_keys, _execute,
+    _get_gcp_credentials, _request_builder, _col_letter
+)
 
 load_dotenv()
 logger = logging.getLogger("admin_bot")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 
 # ========================= Config =========================
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "")
 STUDENTS_SHEET = os.getenv("STUDENT_TABLE_NAME", "Students")
 SUBJECTS_CHANNELS_SHEET = os.getenv("SUBJECTS_CHANNEL_TABLE_NAME", "Subjects_Channels")
@@ -35,16 +41,22 @@ STUDENTS_RANGE = f"{STUDENTS_SHEET}!A2:L"
 
 STUDENT_BOT_TOKEN = os.getenv("STUDENT_BOT_TOKEN")  # used to DM Zoom links & invites
 
+# One student-bot client for every admin action. main() hands over the student application's
+# bot when both run in one process, so its pooled HTTP connections are reused.
+_STUDENT_BOT: Optional[Bot] = None
+
+def _student_bot() -> Bot:
+    global _STUDENT_BOT
+    if _STUDENT_BOT is None:
+        _STUDENT_BOT = Bot(STUDENT_BOT_TOKEN)
+    return _STUDENT_BOT
+
 # ========================= Admins =========================
-def _parse_admin_ids() -> set[int]:
-    raw = os.getenv("ADMIN_IDS", "")
-    ids: set[int] = set()
-    for tok in re.split(r"[,\s]+", raw.strip().strip("'").strip('"')):
-        if tok and tok.strip().lstrip("-").isdigit():
-            ids.add(int(tok))
-    return ids
-
-ADMIN_IDS: set[int] = _parse_admin_ids()
+def _parse_admin_ids() -> frozenset[int]:
+    raw = os.getenv("ADMIN_IDS", "").strip().strip("'").strip('"')
+    return frozenset(int(tok) for tok in raw.replace(",", " ").split() if tok.lstrip("-").isdigit())
+
+ADMIN_IDS: frozenset[int] = _parse_admin_ids()
 ADMIN_FILTER = filters.User(user_id=list(ADMIN_IDS)) if ADMIN_IDS else filters.User(user_id=[])
 
 async def _deny(update: Update):
@@ -66,31 +78,38 @@ def admin_only(func):
     return wrapper
 
 # ========================= Google Sheets helpers =========================
-def _load_gcp_credentials() -> Credentials:
-    path = os.getenv("GOOGLE_CREDENTIALS_FILE")
-    if path and os.path.exists(path):
-        return Credentials.from_service_account_file(path, scopes=SCOPES)
-
-    b64 = os.getenv("GOOGLE_CREDENTIALS_JSON_B64")
-    if b64:
-        info = json.loads(base64.b64decode(b64.strip().strip('"').strip("'")).decode("utf-8"))
-        return Credentials.from_service_account_info(info, scopes=SCOPES)
-
-    raw = os.getenv("GOOGLE_CREDENTIALS_JSON")
-    if raw:
-        info = json.loads(raw)
-        return Credentials.from_service_account_info(info, scopes=SCOPES)
-
-    raise RuntimeError("No Google credentials provided. Set GOOGLE_CREDENTIALS_FILE or GOOGLE_CREDENTIALS_JSON_B64 or GOOGLE_CREDENTIALS_JSON.")
+# Built once per process, on the student bot's credentials and per-thread connections.
+_SHEETS_LOCK = threading.Lock()
+_SHEETS_CLIENT = None
 
 def setup_sheets():
-    creds = _load_gcp_credentials()
-    # cache_discovery=False -> faster cold start, no file cache
-    service = build("sheets", "v4", credentials=creds, cache_discovery=False)
-    return service.spreadsheets(), service
+    global _SHEETS_CLIENT
+    if _SHEETS_CLIENT is None:
+        with _SHEETS_LOCK:
+            if _SHEETS_CLIENT is None:
+                # cache_discovery=False -> no file cache; static_discovery=True -> bundled document, no network fetch
+                service = build(
+                    "sheets", "v4",
+                    credentials=_get_gcp_credentials(),
+                    cache_discovery=False,
+                    static_discovery=True,
+                    requestBuilder=_request_builder,
+                )
+                _SHEETS_CLIENT = (service.spreadsheets(), service)
+    return _SHEETS_CLIENT
+
+# Handlers run blocking Sheets helpers here so the event loop (shared with the student bot)
+# keeps serving updates. Each worker thread gets its own connection via _request_builder.
+# The four workers are also the admin side's Sheets concurrency limit: _execute's backoff
+# sleeps on a worker, so a quota storm slows admin calls down instead of adding to them.
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="admin-sheets")
+
+async def _run_sheets(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SHEETS_POOL, functools.partial(fn, *args, **kwargs))
 
 def get_sheet_id_by_title(service, title: str) -> int:
-    meta = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
+    meta = _execute(service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID))
     for sh in meta.get('sheets', []):
         if sh.get('properties', {}).get('title') == title:
             return sh.get('properties', {}).get('sheetId')
@@ -98,11 +117,16 @@ def get_sheet_id_by_title(service, title: str) -> int:
 
 def read_students_values():
     sheets, _ = setup_sheets()
-    result = sheets.values().get(spreadsheetId=SPREADSHEET_ID, range=STUDENTS_RANGE).execute()
+    result = _execute(sheets.values().get(spreadsheetId=SPREADSHEET_ID, range=STUDENTS_RANGE))
     return result.get('values', [])
 
+_NORM_RE = re.compile(r'[^a-z0-9]')
+
+@functools.lru_cache(maxsize=4096, typed=True)  # typed: 1, 1.0 and True normalize differently
 def _norm(s: object) -> str:
-    return re.sub(r'[^a-z0-9]', '', str(s).lower())
+    s = str(s).lower()
+    # Most headers/keys are already plain ASCII alphanumerics: skip the regex for those.
+    return s if s.isascii() and s.isalnum() else _NORM_RE.sub('', s)
 
 def _header_index_alias(headers: List[str], aliases: List[str],
                         contains_any: Optional[List[str]] = None,
@@ -126,6 +150,13 @@ def _header_index_alias(headers: List[str], aliases: List[str],
     return -1
 
 def _id_str_norm(value: object) -> str:
+    # Fast paths: UNFORMATTED_VALUE gives int IDs, FORMATTED_VALUE gives str
+    t = type(value)
+    if t is int:
+        return str(value)
+    if t is str:
+        s = value.strip()
+        return s[:-2] if s.endswith(".0") else s
     try:
         if isinstance(value, int):
             return str(value)
@@ -138,9 +169,6 @@ def _id_str_norm(value: object) -> str:
     except Exception:
         return str(value)
 
-def _safe_cell(row: List[object], idx: int, default: object = ""):
-    return row[idx] if idx != -1 and len(row) > idx else default
-
 def _chat_id(value: str | int) -> int | str:
     s = str(value).strip()
     if s.endswith(".0"):
@@ -149,44 +177,26 @@ def _chat_id(value: str | int) -> int | str:
 
 # ---------- Subjects_Channels ensure ----------
 def ensure_subject_channels_rows(niveau: str, subjects_csv: str):
-    if not subjects_csv:
-        return
-    subjects = [s.strip() for s in subjects_csv.split(',') if s.strip()]
-    sheets, _ = setup_sheets()
-    existing = sheets.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f'{SUBJECTS_CHANNELS_SHEET}!A2:A'
-    ).execute().get('values', [])
-    existing_keys = set(v[0] for v in existing if v)
-    to_append = []
-    for subj in subjects:
-        normalized = re.sub(r'\s+', '_', subj)
-        key = f"{niveau}_{normalized}"
-        if key not in existing_keys:
-            to_append.append([key, ""])
-    if to_append:
-        sheets.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{SUBJECTS_CHANNELS_SHEET}!A:B',
-            valueInputOption='RAW',
-            insertDataOption='INSERT_ROWS',
-            body={'values': to_append}
-        ).execute()
+    """Add missing niveau_subject keys; checked against the student bot's cached Subjects_Channels index."""
+    subjects = [s.strip() for s in (subjects_csv or "").split(',') if s.strip()]
+    ensure_subject_keys(niveau, subjects)
 
 # ========================= Student CRUD helpers =========================
 def check_phone_exists(phone_number):
     values = read_students_values()
+    want = str(phone_number).strip()
     matches = []
     for r_idx, row in enumerate(values):
-        if len(row) >= 1 and str(row[0]).strip() == str(phone_number).strip():
+        if len(row) >= 1 and str(row[0]).strip() == want:
             matches.append({'row_number': r_idx + 2, 'data': row})
     return (len(matches) > 0), matches
 
 def check_telegram_id_exists(telegram_id):
     values = read_students_values()
+    want = _id_str_norm(telegram_id)
     matches = []
     for r_idx, row in enumerate(values):
-        if len(row) > 5 and _id_str_norm(row[5]) == _id_str_norm(telegram_id):
+        if len(row) > 5 and _id_str_norm(row[5]) == want:
             matches.append({'row_number': r_idx + 2, 'data': row})
     return (len(matches) > 0), matches
 
@@ -201,7 +211,9 @@ def delete_student(row_number):
             }
         }]
     }
-    service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request).execute()
+    # Not idempotent: a 5xx may arrive after the row is gone, and a retry would delete the next one.
+    _execute(service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=request), idempotent=False)
+    invalidate_student_cache()
 
 def add_student(phone, name, subjects, speciality, payment, student_id,
                 register_date, end_date, subscription_status,
@@ -212,15 +224,27 @@ def add_student(phone, name, subjects, speciality, payment, student_id,
         register_date, end_date, subscription_status,
         ten_days_reminder_sent, three_days_reminder_sent, niveau
     ]]
-    sheets.values().append(
+    _execute(sheets.values().append(
         spreadsheetId=SPREADSHEET_ID,
         range=STUDENTS_RANGE,
         valueInputOption='RAW',
         insertDataOption='INSERT_ROWS',
         body={'values': values}
-    ).execute()
+    ), idempotent=False)
+    invalidate_student_cache()
     return student_id
 
+def update_student_cell(row_number: int, column_index: int, value: str):
+    sheets, _ = setup_sheets()
+    col_letter = chr(ord('A') + column_index)  # A..E
+    _execute(sheets.values().update(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f'{STUDENTS_SHEET}!{col_letter}{row_number}',
+        valueInputOption='RAW',
+        body={'values': [[value]]}
+    ))
+    invalidate_student_cache()
+
 # ========================= Conversation states =========================
 (
     PHONE, NAME, TELEGRAM_ID, SUBJECTS, SPECIALITY, PAYMENT,
@@ -233,6 +257,14 @@ EDIT_STUDENT = 'edit_student'
 DELETE_STUDENT = 'delete_student'
 ADD_NEW_STUDENT_SAME_NUMBER = 'add_new_student_same_number'
 
+# Callback-data patterns, compiled once and shared by the handlers in main()
+_RE_EDIT_STUDENT = re.compile('^' + EDIT_STUDENT + '_student_')
+_RE_DELETE_STUDENT = re.compile('^' + DELETE_STUDENT + '_student_')
+_RE_ADD_SAME_NUMBER = re.compile('^' + ADD_NEW_STUDENT_SAME_NUMBER + '$')
+_RE_CONFIRM_ADD = re.compile(r'^confirm_add_(yes|no)$')
+_RE_EDIT_COLUMN = re.compile('^edit_column_')
+_RE_ZOOM_SEND = re.compile(r'^zoom_send_(yes|no)$')
+
 # ========================= /add_student flow =========================
 @admin_only
 async def start_add_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -269,7 +301,7 @@ async def handle_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     phone = update.message.text.strip()
     context.user_data['phone'] = phone
 
-    exists, students = check_phone_exists(phone)
+    exists, students = await _run_sheets(check_phone_exists, phone)
     if exists:
         for student_info in students:
             row_number = student_info['row_number']
@@ -302,7 +334,7 @@ async def handle_telegram_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
         telegram_id_input = str(uuid.uuid4())[:8]
     context.user_data['telegram_id'] = telegram_id_input
 
-    exists, students = check_telegram_id_exists(telegram_id_input)
+    exists, students = await _run_sheets(check_telegram_id_exists, telegram_id_input)
     if exists:
         for student_info in students:
             row_number = student_info['row_number']
@@ -401,10 +433,11 @@ async def confirm_add_student(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
     # Ensure Subjects_Channels keys exist for this niveau+subjects
-    ensure_subject_channels_rows(pending['niveau'], pending['subjects'])
+    await _run_sheets(ensure_subject_channels_rows, pending['niveau'], pending['subjects'])
 
     # Append student to Students
-    add_student(
+    await _run_sheets(
+        add_student,
         pending['phone'], pending['name'], pending['subjects'], pending['speciality'],
         pending['payment'], pending['telegram_id'], pending['register_date'],
         pending['end_date'], pending['subscription_status'],
@@ -412,12 +445,11 @@ async def confirm_add_student(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
     # Auto-send subject group invites if mapped
-    keys = [f"{pending['niveau']}_{re.sub(r'\\s+', '_', s.strip())}".lower()
+    keys = [f"{pending['niveau']}_{'_'.join(s.split())}".lower()
             for s in pending['subjects'].split(',') if s.strip()]
     if keys and STUDENT_BOT_TOKEN:
-        student_bot = Bot(STUDENT_BOT_TOKEN)
         try:
-            await invite_student_to_subject_groups(student_bot, pending['telegram_id'], keys)
+            await invite_student_to_subject_groups(_student_bot(), pending['telegram_id'], keys)
         except Exception as e:
             await query.message.reply_text(f"تمت إضافة الطالب، لكن فشل إرسال الدعوات: {e}")
 
@@ -463,7 +495,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data.startswith(DELETE_STUDENT + '_student_'):
         row_number_str = query.data.replace(DELETE_STUDENT + '_student_', '', 1)
         if row_number_str.isdigit():
-            delete_student(int(row_number_str))
+            await _run_sheets(delete_student, int(row_number_str))
             await query.edit_message_text("تم حذف الطالب بنجاح!")
         else:
             await query.edit_message_text("تعذّر حذف الطالب: رقم الصف غير موجود.")
@@ -511,14 +543,7 @@ async def handle_edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("خطأ: تعذّر استرجاع معلومات التعديل.")
         return ConversationHandler.END
 
-    sheets, _ = setup_sheets()
-    col_letter = chr(ord('A') + column_index)  # A..E
-    sheets.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f'{STUDENTS_SHEET}!{col_letter}{row_number}',
-        valueInputOption='RAW',
-        body={'values': [[new_value]]}
-    ).execute()
+    await _run_sheets(update_student_cell, row_number, column_index, new_value)
 
     await update.message.reply_text("تم تحديث بيانات الطالب بنجاح!")
     context.user_data.pop('edit_row_number', None)
@@ -552,54 +577,82 @@ async def zoom_get_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("يرجى لصق رابط اجتماع Zoom:")
     return ZOOM_URL
 
+# Columns the Zoom fan-out needs: field -> (aliases, contains_any).
+# contains_any None means an exact, case-sensitive headers.index() match on the single alias.
+_ZOOM_FIELDS: Dict[str, tuple] = {
+    "id":           (["ID"], ["id"]),
+    "name":         (["Student Name", "Name"], ["name"]),
+    "subjects":     (["Student Subjects", "Subjects"], ["subject"]),
+    "niveau":       (["Niveau", "Level"], ["niveau", "level"]),
+    "subscription": (["Subscription"], None),
+}
+
+@functools.lru_cache(maxsize=32)
+def _zoom_cols(headers_tuple: tuple) -> Dict[str, int]:
+    """Resolve _ZOOM_FIELDS once per distinct header row."""
+    headers = list(headers_tuple)
+    cols: Dict[str, int] = {}
+    for field, (aliases, any_toks) in _ZOOM_FIELDS.items():
+        if any_toks is None:
+            cols[field] = headers.index(aliases[0]) if aliases[0] in headers else -1
+        else:
+            cols[field] = _header_index_alias(headers, aliases, contains_any=any_toks)
+    return cols
+
+# Students header row as last read. _find_zoom_recipients re-reads it in every batchGet.
+_STUDENTS_HEADER: Dict[str, tuple] = {"row": ()}
+
 def _find_zoom_recipients(niveau: str, subject: str) -> List[Dict[str, str]]:
+    # Only the five columns the filter needs, column-major, instead of the whole A:Z block. They
+    # are located from the last header row seen, which comes back in the same batchGet: when it
+    # differs (or none was cached yet), the columns are resolved again and read once more.
     sheets, _ = setup_sheets()
-    res = sheets.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"{STUDENTS_SHEET}!A:Z",
-        valueRenderOption="UNFORMATTED_VALUE"
-    ).execute()
-    rows = res.get("values", []) or []
-    if len(rows) < 2:
+    headers = _STUDENTS_HEADER["row"]
+    for _ in range(2):
+        cols = _zoom_cols(headers)
+        fields = [f for f in _ZOOM_FIELDS if cols[f] != -1]
+        res = _execute(sheets.values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=[f"{STUDENTS_SHEET}!A1:Z1"] + [
+                f"{STUDENTS_SHEET}!{_col_letter(cols[f])}2:{_col_letter(cols[f])}" for f in fields
+            ],
+            valueRenderOption="UNFORMATTED_VALUE",
+            majorDimension="COLUMNS"
+        ))
+        value_ranges = res.get("valueRanges", []) or []
+        row = tuple(c[0] if c else "" for c in ((value_ranges[0].get("values") if value_ranges else None) or []))
+        if row == headers:
+            break
+        _STUDENTS_HEADER["row"] = headers = row
+    else:
+        return []  # the header row changed between both reads
+    if min(cols["id"], cols["subjects"], cols["niveau"], cols["subscription"]) == -1:
         return []
 
-    headers = rows[0]
-
-    def idx_exact(name: str) -> int:
-        try:
-            return headers.index(name)
-        except ValueError:
-            return -1
-
-    id_idx       = _header_index_alias(headers, ["ID"], contains_any=["id"])
-    name_idx     = _header_index_alias(headers, ["Student Name", "Name"], contains_any=["name"])
-    subjects_idx = _header_index_alias(headers, ["Student Subjects", "Subjects"], contains_any=["subject"])
-    niveau_idx   = _header_index_alias(headers, ["Niveau", "Level"], contains_any=["niveau", "level"])
-    subs_idx     = idx_exact("Subscription")
-
-    if min(id_idx, subjects_idx, niveau_idx, subs_idx) == -1:
-        return []
+    data = {f: (vr.get("values") or [[]])[0] for f, vr in zip(fields, value_ranges[1:])}
+    n_rows = max((len(v) for v in data.values()), default=0)
+    columns = [data.get(f, []) + [""] * (n_rows - len(data.get(f, []))) for f in _ZOOM_FIELDS]
 
     want_level = niveau.strip().lower()
     want_subject = subject.strip().lower()
 
     recipients: List[Dict[str, str]] = []
-    for row in rows[1:]:
-        sub_status = str(_safe_cell(row, subs_idx, "")).strip().upper()
+    for raw_id, raw_name, subjects_val, level_val, subs_val in zip(*columns):
+        sub_status = str(subs_val).strip().upper()
         if sub_status != "TRUE":
             continue
 
-        row_level = str(_safe_cell(row, niveau_idx, "")).strip().lower()
+        row_level = str(level_val).strip().lower()
         if row_level != want_level:
             continue
 
-        subjects_csv = str(_safe_cell(row, subjects_idx, "") or "")
+        subjects_csv = str(subjects_val or "")
         subj_list = [s.strip().lower() for s in subjects_csv.split(",") if s.strip()]
         if want_subject not in subj_list:
             continue
 
-        rid = _id_str_norm(_safe_cell(row, id_idx, ""))
-        name = str(_safe_cell(row, name_idx, "")) if name_idx != -1 else ""
+        rid = _id_str_norm(raw_id)
+        name = str(raw_name)
         if rid:
             recipients.append({"id": rid, "name": name})
 
@@ -616,7 +669,7 @@ async def zoom_get_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     z['url'] = url
     context.user_data['zoom'] = z
 
-    recipients = _find_zoom_recipients(z.get("niveau", ""), z.get("subject", ""))
+    recipients = await _run_sheets(_find_zoom_recipients, z.get("niveau", ""), z.get("subject", ""))
     z['recipients'] = recipients
     context.user_data['zoom'] = z
 
@@ -660,21 +713,13 @@ async def zoom_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop('zoom', None)
         return ConversationHandler.END
 
-    student_bot = Bot(STUDENT_BOT_TOKEN)
-
-    ok, fail = 0, 0
-    for r in recipients:
-        chat_id = _chat_id(r['id'])
-        try:
-            await student_bot.send_message(
-                chat_id=chat_id,
-                text=f"📌 حصة Zoom لـ <b>{niveau} – {subject}</b>\n{url}",
-                parse_mode="HTML",
-                disable_web_page_preview=False
-            )
-            ok += 1
-        except Exception:
-            fail += 1
+    ok, fail = await send_to_many(
+        _student_bot(),
+        [_chat_id(r['id']) for r in recipients],
+        f"📌 حصة Zoom لـ <b>{niveau} – {subject}</b>\n{url}",
+        parse_mode="HTML",
+        disable_web_page_preview=False
+    )
 
     await query.edit_message_text(f"تم. أُرسل الرابط إلى {ok} طالب/طلاب. فشل الإرسال: {fail}.")
     context.user_data.pop('zoom', None)
@@ -688,6 +733,9 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # ========================= Application factory (WEBHOOK-READY) =========================
 async def main(student_app=None, updater_none: bool = False):
+    global _STUDENT_BOT
+    if student_app is not None:
+        _STUDENT_BOT = student_app.bot
     token = os.getenv("ADMIN_BOT_TOKEN")
     builder = Application.builder().token(token)
     if updater_none:
@@ -698,9 +746,9 @@ async def main(student_app=None, updater_none: bool = False):
         entry_points=[
             CommandHandler('add_student', start_add_student, filters=ADMIN_FILTER),
             CommandHandler('zoom', zoom_start, filters=ADMIN_FILTER),
-            CallbackQueryHandler(start_edit_student, pattern='^' + EDIT_STUDENT + '_student_'),
-            CallbackQueryHandler(handle_callback, pattern='^' + DELETE_STUDENT + '_student_'),
-            CallbackQueryHandler(start_add_new_student_same_number, pattern='^' + ADD_NEW_STUDENT_SAME_NUMBER + '$'),
+            CallbackQueryHandler(start_edit_student, pattern=_RE_EDIT_STUDENT),
+            CallbackQueryHandler(handle_callback, pattern=_RE_DELETE_STUDENT),
+            CallbackQueryHandler(start_add_new_student_same_number, pattern=_RE_ADD_SAME_NUMBER),
         ],
         states={
             NAME:   [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, handle_name)],
@@ -710,13 +758,13 @@ async def main(student_app=None, updater_none: bool = False):
             SPECIALITY:  [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, handle_speciality)],
             PAYMENT:     [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, handle_payment)],
             SUBSCRIPTION_PERIOD: [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, handle_subscription_period)],
-            CONFIRM_ADD: [CallbackQueryHandler(confirm_add_student, pattern=r'^confirm_add_(yes|no)$')],
-            EDIT_COLUMN: [CallbackQueryHandler(handle_edit_column, pattern='^edit_column_')],
+            CONFIRM_ADD: [CallbackQueryHandler(confirm_add_student, pattern=_RE_CONFIRM_ADD)],
+            EDIT_COLUMN: [CallbackQueryHandler(handle_edit_column, pattern=_RE_EDIT_COLUMN)],
             EDIT_VALUE:  [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, handle_edit_value)],
             ZOOM_NIVEAU:  [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, zoom_get_niveau)],
             ZOOM_SUBJECT: [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, zoom_get_subject)],
             ZOOM_URL:     [MessageHandler(ADMIN_FILTER & filters.TEXT & ~filters.COMMAND, zoom_get_url)],
-            ZOOM_CONFIRM: [CallbackQueryHandler(zoom_confirm, pattern=r'^zoom_send_(yes|no)$')],
+            ZOOM_CONFIRM: [CallbackQueryHandler(zoom_confirm, pattern=_RE_ZOOM_SEND)],
         },
         fallbacks=[CommandHandler('cancel', cancel, filters=ADMIN_FILTER)],
         allow_reentry=True,
@@ -735,27 +783,26 @@ async def main(student_app=None, updater_none: bool = False):
     return application
 
 # --- Optional warm-up for Render cold starts (admin_bot) ----------------------
-import asyncio
+
+# Concurrent cold-start calls share the in-flight warm-up instead of each starting one.
+_PREWARM_TASK: Optional[asyncio.Task] = None
+
+def _prewarm_sync():
+    try:
+        sheets, _ = setup_sheets()  # builds the shared client handlers use
+        _execute(sheets.values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=[f"{STUDENTS_SHEET}!A1:A1", f"{SUBJECTS_CHANNELS_SHEET}!A1:A1"]
+        ))
+    except Exception as e:
+        logger.warning("[admin_bot prewarm_clients] Warm-up skipped/failed: %s", e)
 
 async def prewarm_clients():
     """
     Pre-initialize Google Sheets creds + client and touch both sheets so the
     first real webhook doesn’t pay the cold-start cost. Safe to call multiple times.
     """
-    def _sync():
-        try:
-            creds = _load_gcp_credentials()
-            service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-            service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{STUDENTS_SHEET}!A1:A1"
-            ).execute()
-            service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNELS_SHEET}!A1:A1"
-            ).execute()
-        except Exception as e:
-            logger.warning("[admin_bot prewarm_clients] Warm-up skipped/failed: %s", e)
-
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _sync)
+    global _PREWARM_TASK
+    if _PREWARM_TASK is None or _PREWARM_TASK.done():
+        _PREWARM_TASK = asyncio.ensure_future(_run_sheets(_prewarm_sync))
+    await asyncio.shield(_PREWARM_TASK)
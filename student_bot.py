@@ -1,17 +1,25 @@
 # student_bot.py
 import os
 import re
+import html
 import json
 import base64
+import asyncio
 import logging
 import difflib
-from typing import List, Set, Dict, Optional, Union, Tuple
+import random
+import functools
+import threading
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Set, FrozenSet, Dict, Optional, Union, Tuple
 from datetime import datetime, timedelta, date, time
 
 from dotenv import load_dotenv
 from telegram import (
     Update, Bot, InlineKeyboardMarkup, InlineKeyboardButton, ForceReply
 )
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     ContextTypes,
@@ -22,8 +30,12 @@ from telegram.ext import (
     filters,
     Defaults,
 )
+import httplib2
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 try:
     from zoneinfo import ZoneInfo  # Python 3.9+
@@ -43,10 +55,10 @@ SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 STUDENT_TABLE_NAME = os.getenv("STUDENT_TABLE_NAME", "Students")
 SUBJECTS_CHANNEL_TABLE_NAME = os.getenv("SUBJECTS_CHANNEL_TABLE_NAME", "Subjects_Channels")
 
-ADMIN_IDS: Set[int] = {
-    int(tok) for tok in re.split(r"[,\s]+", os.getenv("ADMIN_IDS", "").strip().strip("'").strip('"'))
-    if tok.strip().lstrip("-").isdigit()
-}
+ADMIN_IDS: FrozenSet[int] = frozenset(
+    int(tok) for tok in os.getenv("ADMIN_IDS", "").strip().strip("'").strip('"').replace(",", " ").split()
+    if tok.lstrip("-").isdigit()
+)
 
 logger.info("Student bot starting with:")
 logger.info(f"  SPREADSHEET_ID={SPREADSHEET_ID}")
@@ -68,8 +80,18 @@ SET_NIVEAU, SET_SUBJECT, SET_CONFIRM = range(3)
 # Mini flow to add a single subject when user is already registered
 ADD_SUBJECT_INPUT = 11
 
+# Callback-data patterns, compiled once and shared by the handlers in main()
+_RE_SETNIV = re.compile(r"^setniv:")
+_RE_SET_CONFIRM = re.compile(r"^set_confirm_(yes|no)$")
+_RE_REG_NIVEAU = re.compile(r"^niv:")
+_RE_REG_CONFIRM = re.compile(r"^reg_(yes|no)$")
+_RE_ADDSUB_START = re.compile(r"^addsub_start$")
+
 ALLOWED_NIVEAUX = {"3AS", "2AS", "1AS", "4AM", "3AM", "2AM", "1AM"}
 
+_NORM_RE = re.compile(r'[^a-z0-9]')
+_WS_RE = re.compile(r'\s+')
+
 # ===================== Google Sheets helpers =====================
 
 def _load_gcp_credentials() -> Credentials:
@@ -89,6 +111,9 @@ def _load_gcp_credentials() -> Credentials:
 
     raise RuntimeError("No Google credentials provided.")
 
+# Arabic comma/semicolon, fullwidth and ideographic commas, and ASCII/typographic separators
+_FORBIDDEN_SEPARATORS = frozenset("\u060C\u061B\uFF0C\u3001;|/\\:·•")
+
 def _detect_bad_separators(raw: str) -> Optional[str]:
     """
     Return an error message if the input uses non-English commas or other separators.
@@ -99,29 +124,12 @@ def _detect_bad_separators(raw: str) -> Optional[str]:
 
     text = str(raw)
 
-    # Disallow common non-ASCII commas & separators
-    forbidden_chars = {
-        '\u060C': '،',   # Arabic comma
-        '\u061B': '؛',   # Arabic semicolon
-        '\uFF0C': '，',   # Fullwidth comma
-        '\u3001': '、',   # Ideographic comma
-        ';': ';',
-        '؛': '؛',
-        '،': '،',
-        '|': '|',
-        '/': '/',
-        '\\': '\\',
-        ':': ':',
-        '·': '·',
-        '•': '•',
-    }
-    for ch in forbidden_chars:
-        if ch in text:
-            return "⚠️ الرجاء استخدام الفاصلة الإنجليزية فقط للفصل بين المواد: , \nمثال صحيح: Math, Anglais"
+    # Disallow common non-ASCII commas & separators (one C-level pass over the text)
+    if not _FORBIDDEN_SEPARATORS.isdisjoint(text):
+        return "⚠️ الرجاء استخدام الفاصلة الإنجليزية فقط للفصل بين المواد: , \nمثال صحيح: Math, Anglais"
 
-    # Disallow using words as separators
-    lower = text.lower()
-    if " و " in text or " and " in lower:
+    # Disallow using words as separators (" و " can only occur in non-ASCII input)
+    if (not text.isascii() and " و " in text) or " and " in text.lower():
         return "⚠️ لا تستخدم كلمات للربط. استخدم الفاصلة الإنجليزية فقط: , \nمثال صحيح: Math, Anglais"
 
     # Disallow newlines as separators
@@ -131,66 +139,393 @@ def _detect_bad_separators(raw: str) -> Optional[str]:
     return None
 
 
+# One discovery client per process; handlers reuse it instead of rebuilding it per call.
+_SHEETS_LOCK = threading.Lock()
+_SHEETS_RESOURCE = None
+_GCP_CREDS: Optional[Credentials] = None
+_HTTP_LOCAL = threading.local()
+
+def _get_gcp_credentials() -> Credentials:
+    global _GCP_CREDS
+    if _GCP_CREDS is None:
+        _GCP_CREDS = _load_gcp_credentials()
+    return _GCP_CREDS
+
+def _thread_http() -> AuthorizedHttp:
+    """httplib2 is not thread-safe: keep one authorized keep-alive connection per thread."""
+    http = getattr(_HTTP_LOCAL, "http", None)
+    if http is None:
+        http = AuthorizedHttp(_get_gcp_credentials(), http=httplib2.Http(timeout=30))
+        _HTTP_LOCAL.http = http
+    return http
+
+def _request_builder(_http, *args, **kwargs) -> HttpRequest:
+    return HttpRequest(_thread_http(), *args, **kwargs)
+
 def setup_sheets():
-    creds = _load_gcp_credentials()
-    service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-    return service.spreadsheets()
+    global _SHEETS_RESOURCE
+    if _SHEETS_RESOURCE is None:
+        with _SHEETS_LOCK:
+            if _SHEETS_RESOURCE is None:
+                service = build(
+                    'sheets', 'v4',
+                    credentials=_get_gcp_credentials(),
+                    cache_discovery=False,
+                    static_discovery=True,  # bundled sheets/v4 document: no discovery fetch on cold start
+                    requestBuilder=_request_builder,
+                )
+                _SHEETS_RESOURCE = service.spreadsheets()
+    return _SHEETS_RESOURCE
 
-def fetch_subject_channel_links() -> Dict[str, str]:
-    """Return { '<niveau>_<subject>'.lower(): <telegram_group_id or ''> } from Subjects_Channels."""
+# Sheets calls block on HTTP; handlers hand them to a small dedicated pool so the
+# event loop keeps serving updates and concurrent requests stay bounded.
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sheets")
+
+async def _run_sheets(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SHEETS_POOL, functools.partial(fn, *args, **kwargs))
+
+# Google answers 429 (per-minute quota) and 5xx routinely under load: those are retried with
+# jittered exponential backoff. The sleep holds a pool worker, so a quota storm also slows every
+# other Sheets call down instead of piling more requests on. Appends aren't idempotent (a 5xx can
+# come back after the row was written), so they only retry 429s, which are never applied.
+SHEETS_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+SHEETS_MAX_RETRIES = 4
+SHEETS_BACKOFF_BASE = 0.5
+SHEETS_BACKOFF_CAP = 8.0
+
+def _retry_delay(e: HttpError, attempt: int, idempotent: bool) -> Optional[float]:
+    """Backoff before retrying a call that failed on its attempt-th try, or None to give up."""
+    status = getattr(e.resp, "status", None)
+    retryable = status == 429 or (idempotent and status in SHEETS_RETRY_STATUSES)
+    if not retryable or attempt >= SHEETS_MAX_RETRIES:
+        return None
+    delay = min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt + random.random())
+    logger.warning("[sheets] HTTP %s, retrying in %.1fs", status, delay)
+    return delay
+
+def _execute(req, idempotent: bool = True, retry: bool = True):
+    """
+    req.execute() on this worker thread's own connection, retrying transient HttpErrors.
+    Pass retry=False while holding a lock and let _with_lock retry, so no sleep holds the lock.
+    """
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        try:
+            return req.execute(http=_thread_http())
+        except HttpError as e:
+            delay = _retry_delay(e, attempt, idempotent) if retry else None
+            if delay is None:
+                raise
+            sleep(delay)
+
+def _with_lock(lock, fn, *args, idempotent: bool = True):
+    """fn(*args) under lock, retrying transient HttpErrors with the lock released during the backoff."""
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        try:
+            with lock:
+                return fn(*args)
+        except HttpError as e:
+            delay = _retry_delay(e, attempt, idempotent)
+            if delay is None:
+                raise
+            sleep(delay)
+
+async def _sheets_exec(req, idempotent: bool = True):
+    # Requests built on the event loop thread carry that thread's connection; _execute uses the worker's own.
+    return await _run_sheets(_execute, req, idempotent)
+
+async def _write_cells(rng: str, values: List[List[object]]) -> None:
+    """RAW values.update sent right away, for admin-facing writes whose reply reports the outcome."""
+    await _sheets_exec(setup_sheets().values().update(
+        spreadsheetId=SPREADSHEET_ID,
+        range=rng,
+        valueInputOption="RAW",
+        body={"values": values}
+    ))
+
+# Single writer for background cell updates (reminder flags): writes that arrive within
+# WRITE_FLUSH_INTERVAL are sent as one values.batchUpdate (retried by _execute like any other call).
+WRITE_FLUSH_INTERVAL = 0.5
+WRITE_BATCH_MAX = 50
+_WRITE_Q: Optional[asyncio.Queue] = None
+_WRITE_WORKER: Optional[asyncio.Task] = None
+
+async def _queue_write(rng: str, values: List[List[object]]) -> None:
+    """Queue a RAW write of `values` at `rng` and wait until its batch is flushed; flush errors propagate."""
+    global _WRITE_Q, _WRITE_WORKER
+    loop = asyncio.get_running_loop()
+    if _WRITE_WORKER is None or _WRITE_WORKER.done():
+        _WRITE_Q = asyncio.Queue()
+        _WRITE_WORKER = loop.create_task(_write_worker())
+    fut = loop.create_future()
+    await _WRITE_Q.put((rng, values, fut))
+    await fut
+
+async def _write_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _WRITE_Q.get()]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_WRITE_Q.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        await _flush_writes(batch)
+
+async def _flush_writes(batch: List[Tuple[str, List[List[object]], asyncio.Future]]) -> None:
+    data = [{"range": rng, "values": values} for rng, values, _ in batch]
+    error: Optional[Exception] = None
+    try:
+        await _sheets_exec(setup_sheets().values().batchUpdate(
+            spreadsheetId=SPREADSHEET_ID,
+            body={"valueInputOption": "RAW", "data": data}
+        ))
+    except Exception as e:
+        logger.warning("[writes] Could not write %d cell(s): %s", len(data), e)
+        error = e
+    for _, _, fut in batch:
+        if fut.done():
+            continue
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(None)
+
+# Subjects_Channels only changes through /set and subject-row creation, so one read is
+# indexed and served from memory for a while:
+#   map      {key_lower: group_id}               (rows that have a group ID)
+#   row_of   {key_lower: sheet row}              (every keyed row; last one wins)
+#   by_gid   {group_id_norm: [(key, sheet row)]} (for /set conflict checks)
+# A published entry is never mutated: refreshes and patches build new dicts and rebind
+# _SUBJECT_MAP_CACHE, so a caller iterating an entry on the event loop can't see a worker's edit.
+SUBJECT_MAP_TTL = 300.0
+_SUBJECT_MAP_CACHE: Dict[str, object] = {"ts": 0.0, "map": None, "row_of": {}, "by_gid": {}, "has_header": False}
+# Serialises refreshes, patches and invalidation. Held across Sheets I/O, so only take it on
+# the Sheets pool (never on the event loop). Reentrant: the patch helpers invalidate and re-read.
+_SUBJECT_MAP_LOCK = threading.RLock()
+
+def _subject_map_fresh(cache: Dict[str, object]) -> bool:
+    return cache["map"] is not None and monotonic() - cache["ts"] < SUBJECT_MAP_TTL
+
+def invalidate_subject_cache() -> None:
+    """Call after anything writes to the Subjects_Channels sheet."""
+    global _SUBJECT_MAP_CACHE
+    with _SUBJECT_MAP_LOCK:
+        _SUBJECT_MAP_CACHE = {"ts": 0.0, "map": None, "row_of": {}, "by_gid": {}, "has_header": False}
+
+def _subject_channels() -> Dict[str, object]:
+    """Return the indexed Subjects_Channels cache entry, re-reading A:B when it is stale."""
+    cache = _SUBJECT_MAP_CACHE
+    if _subject_map_fresh(cache):
+        return cache
+    return _with_lock(_SUBJECT_MAP_LOCK, _load_subject_channels)
+
+def _load_subject_channels() -> Dict[str, object]:
+    """Re-read A:B into the cache unless another thread just did. Call under _SUBJECT_MAP_LOCK."""
+    global _SUBJECT_MAP_CACHE
+    if _subject_map_fresh(_SUBJECT_MAP_CACHE):
+        return _SUBJECT_MAP_CACHE
     sheets = setup_sheets()
-    result = sheets.values().get(
+    result = _execute(sheets.values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=f'{SUBJECTS_CHANNEL_TABLE_NAME}!A:B'
-    ).execute()
+        range=f'{SUBJECTS_CHANNEL_TABLE_NAME}!A:B',
+        valueRenderOption="FORMATTED_VALUE"
+    ), retry=False)
     values = result.get('values', []) or []
     subject_channel_map: Dict[str, str] = {}
-    for row in values[1:]:  # skip header
-        if row and len(row) >= 2 and row[0]:
-            subject_channel_map[str(row[0]).strip().lower()] = str(row[1]).strip() if len(row) > 1 else ""
-    logger.debug(f"[fetch_subject_channel_links] Loaded {len(subject_channel_map)} keys.")
-    return subject_channel_map
+    row_of: Dict[str, int] = {}
+    by_gid: Dict[str, List[Tuple[str, int]]] = {}
+    for row_num, row in enumerate(values[1:], start=2):  # skip header
+        if not row or not isinstance(row[0], str) or not row[0].strip():
+            continue
+        key_lower = row[0].strip().lower()
+        row_of[key_lower] = row_num
+        if len(row) >= 2:
+            subject_channel_map[key_lower] = str(row[1]).strip()
+            gid_norm = _id_str_norm(row[1])
+            if gid_norm:
+                by_gid.setdefault(gid_norm, []).append((row[0], row_num))
+    logger.debug("[fetch_subject_channel_links] Loaded %d keys.", len(subject_channel_map))
+    _SUBJECT_MAP_CACHE = {
+        "ts": monotonic(), "map": subject_channel_map, "row_of": row_of, "by_gid": by_gid,
+        "has_header": bool(values),
+    }
+    return _SUBJECT_MAP_CACHE
+
+_A1_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+def _record_subject_row(key: str, group_id: str, row_num: Optional[int]) -> None:
+    """
+    Apply a /set write (key -> group_id at row_num) to a copy of the cached index and publish
+    it, so the next lookup doesn't re-read the sheet. Falls back to invalidating when the row
+    is unknown. Takes _SUBJECT_MAP_LOCK: run it on the Sheets pool.
+    """
+    global _SUBJECT_MAP_CACHE
+    with _SUBJECT_MAP_LOCK:
+        cache = _SUBJECT_MAP_CACHE
+        if cache["map"] is None:
+            return
+        if row_num is None:
+            invalidate_subject_cache()
+            return
+        key_lower = key.strip().lower()
+        subject_map = dict(cache["map"])
+        row_of = dict(cache["row_of"])
+        by_gid = dict(cache["by_gid"])  # the lists in it are replaced below, never appended to
+        old_gid = subject_map.get(key_lower)
+        if old_gid:
+            old_norm = _id_str_norm(old_gid)
+            kept = [(k, r) for k, r in by_gid.get(old_norm, []) if r != row_num]
+            if kept:
+                by_gid[old_norm] = kept
+            else:
+                by_gid.pop(old_norm, None)
+        subject_map[key_lower] = group_id
+        row_of[key_lower] = row_num
+        gid_norm = _id_str_norm(group_id)
+        # sheet order, as a fresh read would build it
+        by_gid[gid_norm] = sorted(by_gid.get(gid_norm, []) + [(key, row_num)], key=lambda kr: kr[1])
+        _SUBJECT_MAP_CACHE = dict(cache, map=subject_map, row_of=row_of, by_gid=by_gid)
+
+def _appended_row(response: Optional[Dict[str, object]]) -> Optional[int]:
+    """Row number of a single-row values.append, from its updatedRange (e.g. 'Sheet!A7:B7')."""
+    m = _A1_ROW_RE.search(((response or {}).get("updates") or {}).get("updatedRange", ""))
+    return int(m.group(1)) if m else None
+
+def _verified_subject_row(key_lower: str, row_hint: Optional[int]) -> Optional[int]:
+    """
+    Sheet row holding key_lower, or None if the key has no row. A cached (or pending_set) row
+    is only trusted after reading its A cell back; if the sheet was edited under it, A:B is
+    re-read. A key with no cached row is taken from the index while it is fresh: should the
+    sheet have gained that key meanwhile, the append adds a later duplicate row, and the later
+    row is the one every lookup uses.
+    """
+    if row_hint is not None:
+        res = _execute(setup_sheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A{row_hint}",
+            valueRenderOption="FORMATTED_VALUE"
+        ))
+        cell = (res.get("values") or [[""]])[0]
+        if cell and str(cell[0]).strip().lower() == key_lower:
+            return row_hint
+        invalidate_subject_cache()
+    return _subject_channels()["row_of"].get(key_lower)
+
+async def _write_subject_mapping(key_canonical: str, group_id: str, row_hint: Optional[int]) -> bool:
+    """Point key_canonical at group_id in Subjects_Channels; True if a new row was appended."""
+    row = await _run_sheets(_verified_subject_row, key_canonical.lower(), row_hint)
+    if row is None:
+        written = await _sheets_exec(setup_sheets().values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A:B",
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": [[key_canonical, group_id]]},
+        ), idempotent=False)
+        await _run_sheets(_record_subject_row, key_canonical, group_id, _appended_row(written))
+        return True
+    await _write_cells(f"{SUBJECTS_CHANNEL_TABLE_NAME}!B{row}", [[group_id]])
+    await _run_sheets(_record_subject_row, key_canonical, group_id, row)
+    return False
+
+def fetch_subject_channel_links() -> Dict[str, str]:
+    """Return { '<niveau>_<subject>'.lower(): <telegram_group_id or ''> } from Subjects_Channels."""
+    return _subject_channels()["map"]
 
 def _safe_cell(row: List[object], idx: int, default: object="") -> object:
     return row[idx] if idx != -1 and len(row) > idx else default
 
-def _col_letter(idx_zero_based: int) -> str:
+def _col_letter_compute(idx_zero_based: int) -> str:
     s, n = "", idx_zero_based + 1
     while n:
         n, r = divmod(n - 1, 26)
         s = chr(65 + r) + s
     return s
 
-def _norm(s: object) -> str:
-    return re.sub(r'[^a-z0-9]', '', str(s).lower())
+# A..BL covers every column the bot reads or writes; wider sheets fall back to the loop.
+_COL_LETTERS: List[str] = [_col_letter_compute(i) for i in range(64)]
 
-def _header_index(headers: List[str], target_name: str) -> int:
-    norm = { _norm(h): i for i, h in enumerate(headers) }
-    return norm.get(_norm(target_name), -1)
+def _col_letter(idx_zero_based: int) -> str:
+    if 0 <= idx_zero_based < 64:
+        return _COL_LETTERS[idx_zero_based]
+    return _col_letter_compute(idx_zero_based)
 
-def _header_index_alias(
-    headers: List[str],
-    aliases: List[str],
-    contains_any: Optional[List[str]] = None,
-    contains_all: Optional[List[str]] = None
+@functools.lru_cache(maxsize=4096, typed=True)  # typed: 1, 1.0 and True normalize differently
+def _norm(s: object) -> str:
+    s = str(s).lower()
+    # Most headers/keys are already plain ASCII alphanumerics: skip the regex for those.
+    return s if s.isascii() and s.isalnum() else _NORM_RE.sub('', s)
+
+def _header_index_pre(
+    hdr_norm: List[str],
+    hdr_pos: Dict[str, int],
+    aliases_n: Tuple[str, ...],
+    contains_any_n: Tuple[str, ...] = (),
+    contains_all_n: Tuple[str, ...] = ()
 ) -> int:
-    hdr_norm = [ _norm(h) for h in headers ]
-    for al in aliases:
-        try_idx = _header_index(headers, al)
+    """Like an alias lookup, but every header and token is already _norm()ed by the caller."""
+    for al in aliases_n:
+        try_idx = hdr_pos.get(al, -1)
         if try_idx != -1:
             return try_idx
-    if contains_all:
-        toks = [ _norm(t) for t in contains_all ]
+    if contains_all_n:
         for i, h in enumerate(hdr_norm):
-            if all(t in h for t in toks):
+            if all(t in h for t in contains_all_n):
                 return i
-    if contains_any:
-        toks = [ _norm(t) for t in contains_any ]
+    if contains_any_n:
         for i, h in enumerate(hdr_norm):
-            if any(t in h for t in toks):
+            if any(t in h for t in contains_any_n):
                 return i
     return -1
 
+# Student columns the bot reads: field -> (aliases, contains_any, contains_all)
+_STUDENT_FIELDS: Dict[str, Tuple[List[str], Optional[List[str]], Optional[List[str]]]] = {
+    "id":           (["ID"], ["id"], None),
+    "name":         (["Student Name", "Name"], ["name"], None),
+    "subjects":     (["Student Subjects", "Subjects"], ["subject"], None),
+    "niveau":       (["Niveau", "Level"], ["niveau", "level"], None),
+    "subscription": (["Subscription"], ["subscript"], None),
+    "payment":      (["Payment Method", "Payment"], ["payment"], None),
+    "register":     (["Register_Date", "Register Date"], None, ["register", "date"]),
+    "end":          (["End_Date", "End Date"], None, ["end", "date"]),
+}
+
+# The reminder job matches its columns exactly (case-sensitive), as it always has: the fuzzy
+# "id" token above would also accept a header like "Paid".
+_STUDENT_EXACT_FIELDS: Dict[str, str] = {
+    "reminder_id":           "ID",
+    "reminder_subscription": "Subscription",
+    "ten_day":               "10DaysReminder",
+    "three_day":             "3DaysReminder",
+}
+
+# Same table with every alias/token normalized once at import.
+_STUDENT_FIELDS_N: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]] = {
+    field: tuple(tuple(_norm(t) for t in (toks or ())) for toks in spec)
+    for field, spec in _STUDENT_FIELDS.items()
+}
+
+@functools.lru_cache(maxsize=32)
+def _resolve_headers(headers_tuple: Tuple[object, ...]) -> Dict[str, int]:
+    """Column index (-1 if missing) of every student field, fuzzy or exact, memoized per header row."""
+    hdr_norm = [_norm(h) for h in headers_tuple]
+    hdr_pos = {h: i for i, h in enumerate(hdr_norm)}
+    cols = {
+        field: _header_index_pre(hdr_norm, hdr_pos, aliases_n, any_n, all_n)
+        for field, (aliases_n, any_n, all_n) in _STUDENT_FIELDS_N.items()
+    }
+    for field, name in _STUDENT_EXACT_FIELDS.items():
+        cols[field] = headers_tuple.index(name) if name in headers_tuple else -1
+    return cols
+
+def _student_cols(headers: List[object]) -> Dict[str, int]:
+    return _resolve_headers(tuple(headers))
+
 def _chat_id(value: Union[str, int]) -> Union[int, str]:
     s = str(value).strip()
     if s.endswith(".0"):
@@ -198,6 +533,13 @@ def _chat_id(value: Union[str, int]) -> Union[int, str]:
     return int(s) if s.lstrip("-").isdigit() else s
 
 def _id_str_norm(value: object) -> str:
+    # Fast paths: UNFORMATTED_VALUE gives int IDs, FORMATTED_VALUE gives str
+    t = type(value)
+    if t is int:
+        return str(value)
+    if t is str:
+        s = value.strip()
+        return s[:-2] if s.endswith(".0") else s
     try:
         if isinstance(value, int):
             return str(value)
@@ -212,12 +554,12 @@ def _id_str_norm(value: object) -> str:
 
 def update_sheet_cell(sheets, spreadsheet_id: str, sheet_name: str, col_idx: int, row_index: int, value: object):
     range_name = f'{sheet_name}!{_col_letter(col_idx)}{row_index}'
-    sheets.values().update(
+    _execute(sheets.values().update(
         spreadsheetId=spreadsheet_id,
         range=range_name,
         valueInputOption='RAW',
         body={'values': [[value]]}
-    ).execute()
+    ))
 
 def _to_bool(v: object) -> bool:
     if v is True or v == 1:
@@ -226,74 +568,257 @@ def _to_bool(v: object) -> bool:
         return False
     return str(v).strip().upper() == "TRUE"
 
+_SHEETS_EPOCH = date(1899, 12, 30)
+
+def _serial_to_date(v: object) -> date:
+    """Sheets date serial (days since 1899-12-30, as returned by UNFORMATTED_VALUE) -> date."""
+    return _SHEETS_EPOCH + timedelta(days=int(v))
+
+def _iso_to_date(v: object) -> date:
+    s = str(v).strip()
+    try:
+        return date.fromisoformat(s)
+    except ValueError:
+        # strptime also takes unpadded parts such as 2025-1-5
+        return datetime.strptime(s, "%Y-%m-%d").date()
+
+def _sheet_date(v: object) -> date:
+    return _serial_to_date(v) if isinstance(v, (int, float)) else _iso_to_date(v)
+
+def _sheet_date_or_none(v: object) -> Optional[date]:
+    if v in ("", None):
+        return None
+    try:
+        return _sheet_date(v)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
 # ===================== Student data helpers =====================
 
-def _find_student_row_by_id(student_id: str):
-    """Return (row_num, headers, row) or (None, headers, None)."""
+# Header row + {normalized ID: row number}, so one student's lookup only reads that student's row.
+STUDENT_INDEX_TTL = 60.0
+# Until the first build, id_idx holds where _append_student_row puts the ID (column F), so even
+# the cold build (normally prewarm's) fetches header and IDs in one batchGet.
+_STUDENT_INDEX: Dict[str, object] = {"ts": 0.0, "headers": [], "id_idx": 5, "by_id": {}}
+_STUDENT_INDEX_LOCK = threading.Lock()
+
+# Parsed per-student records, so /subjects, /check and /register follow-ups reuse one row read.
+STUDENT_RECORD_TTL = 60.0
+_STUDENT_CACHE: Dict[str, Tuple[float, Dict[str, object]]] = {}
+
+def invalidate_student_cache(student_id: Optional[str] = None) -> None:
+    """
+    Call after anything writes to the Students sheet. With a student_id only that
+    student's record is dropped; without one the ID index is rebuilt too.
+    """
+    if student_id is not None:
+        _STUDENT_CACHE.pop(_id_str_norm(student_id), None)
+        return
+    _STUDENT_CACHE.clear()
+    _STUDENT_INDEX["ts"] = 0.0
+
+def _student_index() -> Tuple[List[object], int, Dict[str, int]]:
+    """Return (headers, id_idx, {normalized_id: row_num}), refreshed every STUDENT_INDEX_TTL seconds."""
+    with _STUDENT_INDEX_LOCK:
+        if monotonic() - _STUDENT_INDEX["ts"] < STUDENT_INDEX_TTL:
+            return _STUDENT_INDEX["headers"], _STUDENT_INDEX["id_idx"], _STUDENT_INDEX["by_id"]
+    return _with_lock(_STUDENT_INDEX_LOCK, _build_student_index)
+
+def _build_student_index() -> Tuple[List[object], int, Dict[str, int]]:
+    """Call under _STUDENT_INDEX_LOCK; a no-op when another thread has just rebuilt the index."""
+    if monotonic() - _STUDENT_INDEX["ts"] < STUDENT_INDEX_TTL:
+        return _STUDENT_INDEX["headers"], _STUDENT_INDEX["id_idx"], _STUDENT_INDEX["by_id"]
     sheets = setup_sheets()
-    res = sheets.values().get(
+    # Header and ID column in one batchGet, guessing the ID column from the last refresh;
+    # only a moved ID column costs a second round trip.
+    guess = _STUDENT_INDEX["id_idx"]
+    ranges = [f"{STUDENT_TABLE_NAME}!A1:Z1"]
+    if guess != -1:
+        ranges.append(f"{STUDENT_TABLE_NAME}!{_col_letter(guess)}2:{_col_letter(guess)}")
+    res = _execute(sheets.values().batchGet(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{STUDENT_TABLE_NAME}!A:Z",
-        valueRenderOption="UNFORMATTED_VALUE"
-    ).execute()
-    rows = res.get("values", []) or []
-    if len(rows) < 2:
-        return None, [], None
-    headers = rows[0]
-    id_idx = _header_index_alias(headers, ["ID"], contains_any=["id"])
-    if id_idx == -1:
-        return None, headers, None
+        ranges=ranges,
+        valueRenderOption="UNFORMATTED_VALUE",
+        majorDimension="COLUMNS"
+    ), retry=False)
+    value_ranges = res.get("valueRanges", []) or []
+    headers = _header_row(value_ranges[0] if value_ranges else {})
+    id_idx = _student_cols(headers)["id"] if headers else -1
+    by_id: Dict[str, int] = {}
+    if id_idx != -1:
+        if id_idx == guess and len(value_ranges) > 1:
+            ids = (value_ranges[1].get("values") or [[]])[0]
+        else:
+            col = _col_letter(id_idx)
+            res = _execute(sheets.values().get(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{STUDENT_TABLE_NAME}!{col}2:{col}",
+                valueRenderOption="UNFORMATTED_VALUE",
+                majorDimension="COLUMNS"
+            ), retry=False)
+            ids = (res.get("values") or [[]])[0]
+        for rnum, raw_rid in enumerate(ids, start=2):
+            rid_norm = _id_str_norm(raw_rid)
+            if rid_norm and rid_norm not in by_id:
+                by_id[rid_norm] = rnum
+    _STUDENT_INDEX.update(ts=monotonic(), headers=headers, id_idx=id_idx, by_id=by_id)
+    return headers, id_idx, by_id
+
+def _read_student_row(row_num: int) -> List[object]:
+    res = _execute(setup_sheets().values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"{STUDENT_TABLE_NAME}!A{row_num}:Z{row_num}",
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="SERIAL_NUMBER"
+    ))
+    return (res.get("values") or [[]])[0]
+
+def _header_row(value_range: Dict[str, object]) -> List[object]:
+    """Header cells from a column-major A1:Z1 value range (empty columns come back as [])."""
+    return [c[0] if c else "" for c in (value_range.get("values") or [])]
+
+def _read_student_columns(fields: List[str]) -> Optional[Tuple[Dict[str, int], Dict[str, List[object]]]]:
+    """
+    batchGet only the given _STUDENT_FIELDS / _STUDENT_EXACT_FIELDS columns (row 2 down, column-major).
+    Returns (cols, {field: values}) with every column padded with "" to the same length, so
+    callers can zip() them row by row; absent columns come back all "". None if there is no header row.
+
+    One Sheets call: columns are located from the last known header row, which is re-read in the
+    same batchGet. Only when no header is known yet, or it has changed, is the student index
+    rebuilt first and the read repeated.
+    """
+    for attempt in range(2):
+        headers = _STUDENT_INDEX["headers"] if attempt == 0 else []
+        if not headers:
+            headers, _, _ = _student_index()
+            if not headers:
+                return None
+        cols = _student_cols(headers)
+        present = [f for f in fields if cols[f] != -1]
+        res = _execute(setup_sheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=[f"{STUDENT_TABLE_NAME}!A1:Z1"] + [
+                f"{STUDENT_TABLE_NAME}!{_col_letter(cols[f])}2:{_col_letter(cols[f])}" for f in present
+            ],
+            valueRenderOption="UNFORMATTED_VALUE",
+            dateTimeRenderOption="SERIAL_NUMBER",
+            majorDimension="COLUMNS"
+        ))
+        value_ranges = res.get("valueRanges", []) or []
+        if attempt or _header_row(value_ranges[0] if value_ranges else {}) == list(headers):
+            break
+        # The header row changed under the cached index: rebuild it and read again.
+        invalidate_student_cache()
+    data: Dict[str, List[object]] = {f: [] for f in fields}
+    if not present:
+        return cols, data
+    for f, vr in zip(present, value_ranges[1:]):
+        data[f] = (vr.get("values") or [[]])[0]
+    n_rows = max(len(v) for v in data.values())
+    for f, values in data.items():
+        if len(values) < n_rows:
+            values.extend([""] * (n_rows - len(values)))
+    return cols, data
+
+def _is_known_student(student_id: str) -> bool:
+    """Existence check against the cached ID index only (no row read)."""
+    _, _, by_id = _student_index()
+    return _id_str_norm(student_id) in by_id
+
+def _find_student_row_by_id(student_id: str):
+    """Return (row_num, headers, row) or (None, headers, None)."""
     sid_norm = _id_str_norm(student_id)
-    for rnum, row in enumerate(rows[1:], start=2):
-        raw_rid = _safe_cell(row, id_idx, "")
-        rid_norm = _id_str_norm(raw_rid)
-        if rid_norm == sid_norm:
-            return rnum, headers, row
+    for attempt in range(2):
+        headers, id_idx, by_id = _student_index()
+        if not headers:
+            return None, [], None
+        if id_idx == -1:
+            return None, headers, None
+        row_num = by_id.get(sid_norm)
+        if row_num is None:
+            return None, headers, None
+        row = _read_student_row(row_num)
+        if _id_str_norm(_safe_cell(row, id_idx, "")) == sid_norm:
+            return row_num, headers, row
+        # Rows moved since the index was built (e.g. a deletion): rebuild it once.
+        invalidate_student_cache()
     return None, headers, None
 
-def _get_student_subjects_and_niveau(student_id: str) -> Optional[Dict[str, object]]:
+def _fetch_student_record(student_id: str) -> Optional[Dict[str, object]]:
+    """
+    Return the student's parsed row (name, subjects, niveau, subscription, payment,
+    register/end as date or None plus their raw cells, row_num) or None, served from
+    _STUDENT_CACHE within STUDENT_RECORD_TTL.
+    """
+    sid_norm = _id_str_norm(student_id)
+    hit = _STUDENT_CACHE.get(sid_norm)
+    if hit and monotonic() - hit[0] < STUDENT_RECORD_TTL:
+        return hit[1]
     row_num, headers, row = _find_student_row_by_id(student_id)
     if not row:
+        _STUDENT_CACHE.pop(sid_norm, None)
         return None
-    name_idx = _header_index_alias(headers, ["Student Name", "Name"], contains_any=["name"])
-    subjects_idx = _header_index_alias(headers, ["Student Subjects", "Subjects"], contains_any=["subject"])
-    niveau_idx = _header_index_alias(headers, ["Niveau", "Level"], contains_any=["niveau", "level"])
-    subs_idx = _header_index_alias(headers, ["Subscription"], contains_any=["subscript"])
-    subjects_csv = str(_safe_cell(row, subjects_idx, "") or "")
-    subjects = [s.strip() for s in subjects_csv.split(",") if s.strip()]
-    niveau = str(_safe_cell(row, niveau_idx, "") or "")
-    name = str(_safe_cell(row, name_idx, "") or "")
-    subs_val = str(_safe_cell(row, subs_idx, "") or "").strip().upper()
-    return {"name": name, "subjects": subjects, "niveau": niveau, "subscription": (subs_val == "TRUE")}
+    cols = _student_cols(headers)
+    subjects_csv = str(_safe_cell(row, cols["subjects"], "") or "")
+    subs_val = str(_safe_cell(row, cols["subscription"], "") or "").strip().upper()
+    record: Dict[str, object] = {
+        "row_num": row_num,
+        "name": str(_safe_cell(row, cols["name"], "") or ""),
+        "subjects": [s.strip() for s in subjects_csv.split(",") if s.strip()],
+        "niveau": str(_safe_cell(row, cols["niveau"], "") or ""),
+        "subscription": (subs_val == "TRUE"),
+        "payment": _safe_cell(row, cols["payment"], ""),
+        "register_raw": _safe_cell(row, cols["register"], ""),
+        "end_raw": _safe_cell(row, cols["end"], ""),
+    }
+    record["register"] = _sheet_date_or_none(record["register_raw"])
+    record["end"] = _sheet_date_or_none(record["end_raw"])
+    _STUDENT_CACHE[sid_norm] = (monotonic(), record)
+    return record
 
 def _key_for(niveau: str, subject: str) -> str:
-    normalized_subject = re.sub(r'\s+', '_', subject.strip())
-    return f"{niveau}_{normalized_subject}"
+    s = subject.strip()
+    # isprintable() is False for every whitespace except " ", so this skips the split exactly when it would be a no-op.
+    if " " not in s and s.isprintable():
+        return f"{niveau}_{s}"
+    return f"{niveau}_{'_'.join(s.split())}"
 
 # ---------- Subjects_Channels ensure ----------
 def ensure_subject_channels_rows(niveau: str, subjects: List[str]):
     if not subjects:
         return
-    sheets = setup_sheets()
-    existing = sheets.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f'{SUBJECTS_CHANNEL_TABLE_NAME}!A2:A'
-    ).execute().get('values', []) or []
-    existing_keys = set(v[0] for v in existing if v)
+    _subject_channels()  # refresh first, so a read error is retried like any idempotent call
+    # Check, append and patch under one lock hold, so two registrations can't both append the
+    # same key. Only 429s are retried (appends aren't idempotent), with the lock released.
+    _with_lock(_SUBJECT_MAP_LOCK, _append_missing_subject_rows, niveau, subjects, idempotent=False)
+
+def _append_missing_subject_rows(niveau: str, subjects: List[str]):
+    global _SUBJECT_MAP_CACHE
+    existing_keys = _load_subject_channels()["row_of"]  # lowercased, same as every other key lookup
     to_append = []
     for subj in subjects:
-        normalized = re.sub(r'\s+', '_', subj)
-        key = f"{niveau}_{normalized}"
-        if key not in existing_keys:
+        key = _key_for(niveau, subj)
+        if key.lower() not in existing_keys:
             to_append.append([key, ""])
     if to_append:
-        sheets.values().append(
+        sheets = setup_sheets()
+        res = _execute(sheets.values().append(
             spreadsheetId=SPREADSHEET_ID,
             range=f'{SUBJECTS_CHANNEL_TABLE_NAME}!A:B',
             valueInputOption='RAW',
             insertDataOption='INSERT_ROWS',
             body={'values': to_append}
-        ).execute()
+        ), idempotent=False, retry=False)
+        # New keys have no group yet, so only row_of changes: record them instead of re-reading A:B.
+        first_row = _appended_row(res)
+        cache = _SUBJECT_MAP_CACHE
+        if first_row is None or cache["map"] is None or not cache["has_header"]:
+            invalidate_subject_cache()
+        else:
+            row_of = dict(cache["row_of"])
+            for offset, (key, _) in enumerate(to_append):
+                row_of.setdefault(key.lower(), first_row + offset)
+            _SUBJECT_MAP_CACHE = dict(cache, row_of=row_of)
 
 # ---------- Allowed subject labels & mapping ----------
 
@@ -335,21 +860,30 @@ SYN_TO_LABEL: Dict[str, str] = {
     "science": "Science", "sciences": "Science", "sci": "Science", "علوم": "Science",
 }
 
+# Compared against the input with all whitespace removed, so spaces are stripped here once
+_HISTOIRE_GEO_PATTERNS = tuple(p.replace(" ", "") for p in (
+    "histoire geo", "histoire-geo", "histoiregéographie", "histoire et geo",
+    "history geo", "history geography", "history&geography", "histoiregeo",
+    "histoire et géo", "geo histoire", "histoire & geo",
+))
+
 def _looks_like_histoire_geo(text: str) -> bool:
     t = text.lower().strip()
-    t_nospace = re.sub(r"\s+", "", t)
-    patterns = [
-        "histoire geo", "histoire-geo", "histoiregéographie", "histoire et geo",
-        "history geo", "history geography", "history&geography", "histoiregeo",
-        "histoire et géo", "geo histoire", "histoire & geo",
-    ]
-    if any(p.replace(" ", "") in t_nospace for p in patterns):
+    t_nospace = _WS_RE.sub("", t)
+    if any(p in t_nospace for p in _HISTOIRE_GEO_PATTERNS):
         return True
     # If it contains both roots "histoire" and "geo" (or "history" and "geo")
     if ("histoire" in t and "geo" in t) or ("history" in t and "geo" in t):
         return True
     return False
 
+# Exact (lowercased) inputs resolved at import time, so the usual answers skip the pattern scan
+# and fuzzy matching; built from the same rules _label_from_input applies to them.
+_LABEL_EXACT: Dict[str, Tuple[str, str]] = {
+    **{syn: (label, "synonym") for syn, label in SYN_TO_LABEL.items() if not _looks_like_histoire_geo(syn)},
+    **{lb.lower(): ("Histoire Geo", "combo") for lb in ("Histoire Geo", "Histoire-Geo", "History Geography")},
+}
+
 def _label_from_input(raw: str) -> Tuple[Optional[str], Optional[str]]:
     """
     Try to map input text to one of ALLOWED_LABELS.
@@ -359,12 +893,15 @@ def _label_from_input(raw: str) -> Tuple[Optional[str], Optional[str]]:
     txt = (raw or "").strip()
     if not txt:
         return None, None
+    hit = _LABEL_EXACT.get(txt.lower())
+    if hit:
+        return hit
 
     if _looks_like_histoire_geo(txt):
         return "Histoire Geo", "combo"
 
     base = txt.lower().replace("’", "'").strip()
-    base_compact = re.sub(r"\s+", "", base)
+    base_compact = _WS_RE.sub("", base)
 
     if base in SYN_TO_LABEL:
         return SYN_TO_LABEL[base], "synonym"
@@ -372,12 +909,18 @@ def _label_from_input(raw: str) -> Tuple[Optional[str], Optional[str]]:
         return SYN_TO_LABEL[base_compact], "synonym"
 
     # Fuzzy to allowed labels (strictly within ALLOWED_LABELS)
-    match = difflib.get_close_matches(txt, ALLOWED_LABELS, n=1, cutoff=0.75)
+    match = _fuzzy_label(txt)
     if match:
-        return match[0], "fuzzy"
+        return match, "fuzzy"
 
     return None, None
 
+@functools.lru_cache(maxsize=1024)
+def _fuzzy_label(txt: str) -> Optional[str]:
+    """difflib fallback for inputs no synonym matched; the same typos recur, so results are memoized."""
+    match = difflib.get_close_matches(txt, ALLOWED_LABELS, n=1, cutoff=0.75)
+    return match[0] if match else None
+
 def _underlying_for_labels(labels: List[str]) -> List[str]:
     out: List[str] = []
     for lb in labels:
@@ -391,197 +934,300 @@ def _underlying_for_labels(labels: List[str]) -> List[str]:
             dedup.append(s)
     return dedup
 
-# ===================== Reminders job (10d + 3d) =====================
+# ===================== Telegram fan-out =====================
 
-async def check_subscriptions_and_send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    sheets = setup_sheets()
-    result = sheets.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"{STUDENT_TABLE_NAME}!A:Z",
-        valueRenderOption="UNFORMATTED_VALUE"
-    ).execute()
+# Telegram allows about 30 messages/second per bot. Bulk sends run concurrently, but each one
+# takes a slot that is only handed back a second later, so at most this many start per second.
+TG_SENDS_PER_SECOND = 25
+_TG_SEND_SLOTS: Optional[asyncio.Semaphore] = None
 
-    rows = result.get("values", []) or []
-    if len(rows) < 2:
-        return
+async def _tg_send_slot() -> None:
+    global _TG_SEND_SLOTS
+    if _TG_SEND_SLOTS is None:
+        _TG_SEND_SLOTS = asyncio.Semaphore(TG_SENDS_PER_SECOND)
+    await _TG_SEND_SLOTS.acquire()
+    asyncio.get_running_loop().call_later(1.0, _TG_SEND_SLOTS.release)
 
-    headers = rows[0]
-    def idx_exact(name: str) -> int:
+async def _send_limited(bot: Bot, chat_id: Union[int, str], text: str, **kwargs) -> bool:
+    """
+    Rate-limited send_message for bulk fan-out; True if Telegram accepted it.
+    A flood-control RetryAfter is waited out and the send retried once.
+    """
+    for attempt in range(2):
+        await _tg_send_slot()
         try:
-            return headers.index(name)
-        except ValueError:
-            return -1
+            await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return True
+        except RetryAfter as e:
+            if attempt:
+                break
+            delay = e.retry_after
+            await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+        except Exception as e:
+            logger.debug("[fan-out] send to %s failed: %s", chat_id, e)
+            return False
+    logger.debug("[fan-out] send to %s still rate-limited after retry", chat_id)
+    return False
+
+async def send_to_many(bot: Bot, chat_ids: List[Union[int, str]], text: str, **kwargs) -> Tuple[int, int]:
+    """Send one text to many chats concurrently under the shared rate cap -> (sent, failed)."""
+    results = await asyncio.gather(*(_send_limited(bot, cid, text, **kwargs) for cid in chat_ids))
+    sent = sum(results)
+    return (sent, len(results) - sent)
+
+# Join-request invite links have no member limit, so one link per group is shared by every
+# student who asks within INVITE_LINK_TTL instead of minting a new link per request.
+INVITE_LINK_TTL = 600.0
+_INVITE_CACHE: Dict[str, Tuple[str, float]] = {}
+# Creations in flight: concurrent misses for the same group await one Bot API call.
+_INVITE_PENDING: Dict[str, asyncio.Task] = {}
+
+async def _create_invite_link(bot: Bot, group_id: Union[int, str], key: str) -> str:
+    link_obj = await bot.create_chat_invite_link(chat_id=_chat_id(group_id), creates_join_request=True)
+    _INVITE_CACHE[key] = (link_obj.invite_link, monotonic())
+    return link_obj.invite_link
+
+async def _invite_link(bot: Bot, group_id: Union[int, str]) -> str:
+    """Return a join-request invite link for group_id, reusing a recent one when possible."""
+    key = _id_str_norm(group_id)
+    hit = _INVITE_CACHE.get(key)
+    if hit and monotonic() - hit[1] < INVITE_LINK_TTL:
+        return hit[0]
+    task = _INVITE_PENDING.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_create_invite_link(bot, group_id, key))
+        _INVITE_PENDING[key] = task
+        task.add_done_callback(lambda _t: _INVITE_PENDING.pop(key, None))
+    return await asyncio.shield(task)
+
+async def _deliver_invite(bot: Bot, telegram_id: Union[int, str], key: str, group_id: str) -> bool:
+    """Create (or reuse) the group's invite link and DM it to one student under the shared send cap; True if sent."""
+    try:
+        invite_url = await _invite_link(bot, group_id)
+    except Exception as e:
+        logger.error(f"[invite] Could not create invite for {key}: {e}")
+        return False
+    try:
+        chat_id = int(telegram_id)
+    except (TypeError, ValueError):
+        logger.error(f"[invite] Bad Telegram ID {telegram_id!r} for {key}")
+        return False
+    if not await _send_limited(bot, chat_id, f"رابط الدعوة لمجموعة {key}:\n{invite_url}"):
+        logger.error(f"[invite] Could not send invite for {key} to {telegram_id}")
+        return False
+    return True
+
+# ===================== Reminders job (10d + 3d) =====================
+
+# Reminders delivered by this process whose sheet flag write hasn't landed yet, keyed by
+# (student_id, end date) so a renewal starts fresh. The next run re-queues the flag instead of
+# messaging the student again; an entry is dropped once its write succeeds (or the sheet shows
+# the flag), so the sheet stays authoritative and an admin can reset a flag to resend.
+_SENT_10D: Set[Tuple[str, date]] = set()
+_SENT_3D: Set[Tuple[str, date]] = set()
+_SENT_EXPIRED: Set[Tuple[str, date]] = set()
 
-    id_idx           = idx_exact("ID")
-    end_date_idx     = _header_index_alias(headers, ["End_Date", "End Date"], contains_all=["end", "date"])
-    subscription_idx = idx_exact("Subscription")
-    ten_day_idx      = idx_exact("10DaysReminder")
-    three_day_idx    = idx_exact("3DaysReminder")
+async def check_subscriptions_and_send_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Daily reminder pass: normally exactly 2 Sheets calls, one batchGet (header row plus the five
+    columns) and one batchUpdate of all flag flips through the write queue (none if nothing
+    changed; one more per WRITE_BATCH_MAX flags beyond the first batch). The student index is
+    only rebuilt first, one or two extra reads, when no header row is known yet (first use
+    after start) or it changed since the last read. _execute retries of 429/5xx come on top.
+    """
+    read = await _run_sheets(
+        _read_student_columns, ["reminder_id", "end", "reminder_subscription", "ten_day", "three_day"]
+    )
+    if not read:
+        return
+
+    cols, data = read
+    id_idx           = cols["reminder_id"]
+    end_date_idx     = cols["end"]
+    subscription_idx = cols["reminder_subscription"]
+    ten_day_idx      = cols["ten_day"]
+    three_day_idx    = cols["three_day"]
     if id_idx == -1 or end_date_idx == -1 or subscription_idx == -1:
         return
+    end_col, subs_col = data["end"], data["reminder_subscription"]
+    ten_col, three_col = data["ten_day"], data["three_day"]
 
     today = date.today()
-
-    for sheet_row_num, row in enumerate(rows[1:], start=2):
-        raw_id = _safe_cell(row, id_idx, "")
+    pending_updates: List[Dict[str, object]] = []
+
+    # The column is normally all serials or all ISO strings: pick the parser once from the
+    # first filled cell; _sheet_date only runs for odd cells that don't match it.
+    first_end = next((v for v in end_col if v not in ("", None)), None)
+    parse_end = _serial_to_date if isinstance(first_end, (int, float)) else _iso_to_date
+
+    def _flag(col_idx: int, row_num: int, value: str, sent: Optional[tuple] = None, sid: Optional[str] = None) -> None:
+        # sent: (set, key) to clear once written; sid: student whose cached record the write changes
+        pending_updates.append({
+            "range": f"{STUDENT_TABLE_NAME}!{_col_letter(col_idx)}{row_num}",
+            "values": [[value]],
+            "sent": sent,
+            "sid": sid,
+        })
+
+    # (chat_id, text, (sent set, sent key, flag column, sheet row) to record on success, or None)
+    outbox: List[Tuple[Union[int, str], str, Optional[tuple]]] = []
+
+    rows = zip(data["reminder_id"], end_col, subs_col, ten_col, three_col)
+    for sheet_row_num, (raw_id, end_date_val, sub_val, ten_val, three_val) in enumerate(rows, start=2):
         if raw_id in ("", None):
             continue
 
         student_id = _chat_id(raw_id)
-        end_date_val = _safe_cell(row, end_date_idx, "")
         if not end_date_val:
             continue
 
-        if isinstance(end_date_val, (int, float)):
-            end_dt = date(1899, 12, 30) + timedelta(days=int(end_date_val))
-        else:
-            end_dt = datetime.strptime(str(end_date_val).strip(), "%Y-%m-%d").date()
+        try:
+            end_dt = parse_end(end_date_val)
+        except (TypeError, ValueError):
+            end_dt = _sheet_date(end_date_val)
 
-        sub_status = str(_safe_cell(row, subscription_idx, "")).strip().upper()
+        sub_status = str(sub_val).strip().upper()
         days_left = (end_dt - today).days
 
-        ten_sent   = _to_bool(_safe_cell(row, ten_day_idx, False)) if ten_day_idx   != -1 else False
-        three_sent = _to_bool(_safe_cell(row, three_day_idx, False)) if three_day_idx != -1 else False
+        sent_key = (_id_str_norm(raw_id), end_dt)
+        for sent, flag_val, col_idx in ((_SENT_10D, ten_val, ten_day_idx), (_SENT_3D, three_val, three_day_idx)):
+            if col_idx == -1:
+                continue
+            if _to_bool(flag_val):
+                sent.discard(sent_key)
+            elif sent_key in sent:
+                _flag(col_idx, sheet_row_num, "TRUE", sent=(sent, sent_key))  # delivered, write was lost
+        ten_sent   = _to_bool(ten_val) or sent_key in _SENT_10D
+        three_sent = _to_bool(three_val) or sent_key in _SENT_3D
 
         if today > end_dt:
             if sub_status == "TRUE":
-                try:
-                    col = _col_letter(subscription_idx)
-                    setup_sheets().values().update(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f"{STUDENT_TABLE_NAME}!{col}{sheet_row_num}",
-                        valueInputOption="RAW",
-                        body={"values": [["FALSE"]]}
-                    ).execute()
-                except Exception:
-                    pass
-                try:
-                    await context.bot.send_message(
-                        chat_id=student_id,
-                        text="⏳ انتهى اشتراكك. يرجى التجديد لمواصلة الوصول."
-                    )
-                except Exception:
-                    pass
+                _flag(subscription_idx, sheet_row_num, "FALSE", sent=(_SENT_EXPIRED, sent_key), sid=sent_key[0])
+                if sent_key in _SENT_EXPIRED:
+                    continue
+                _SENT_EXPIRED.add(sent_key)
+                outbox.append((student_id, "⏳ انتهى اشتراكك. يرجى التجديد لمواصلة الوصول.", None))
+            else:
+                _SENT_EXPIRED.discard(sent_key)
             continue
 
         if sub_status != "TRUE":
             continue
 
         if 2 <= days_left <= 10 and not ten_sent and ten_day_idx != -1:
-            try:
-                await context.bot.send_message(
-                    chat_id=student_id,
-                    text=(f"⏳ سينتهي اشتراكك في {end_dt.isoformat()}.\n"
-                          f"متبقّي {days_left} يوم/أيام. يرجى التجديد قريبًا.")
-                )
-                col = _col_letter(ten_day_idx)
-                setup_sheets().values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f"{STUDENT_TABLE_NAME}!{col}{sheet_row_num}",
-                    valueInputOption="RAW",
-                    body={"values": [["TRUE"]]}
-                ).execute()
-            except Exception:
-                pass
+            outbox.append((
+                student_id,
+                (f"⏳ سينتهي اشتراكك في {end_dt.isoformat()}.\n"
+                 f"متبقّي {days_left} يوم/أيام. يرجى التجديد قريبًا."),
+                (_SENT_10D, sent_key, ten_day_idx, sheet_row_num),
+            ))
 
         if 0 <= days_left <= 3 and not three_sent and three_day_idx != -1:
-            try:
-                msg = ("⏳ ينتهي اشتراكك اليوم."
-                       if days_left == 0 else
-                       f"⏳ سينتهي اشتراكك في {end_dt.isoformat()}. متبقّي {days_left} يوم/أيام.")
-                await context.bot.send_message(chat_id=student_id, text=msg)
-                col = _col_letter(three_day_idx)
-                setup_sheets().values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f"{STUDENT_TABLE_NAME}!{col}{sheet_row_num}",
-                    valueInputOption="RAW",
-                    body={"values": [["TRUE"]]}
-                ).execute()
-            except Exception:
-                pass
+            msg = ("⏳ ينتهي اشتراكك اليوم."
+                   if days_left == 0 else
+                   f"⏳ سينتهي اشتراكك في {end_dt.isoformat()}. متبقّي {days_left} يوم/أيام.")
+            outbox.append((student_id, msg, (_SENT_3D, sent_key, three_day_idx, sheet_row_num)))
+
+    # Chats are sent to concurrently (rate-capped), but one chat's messages stay in scan order,
+    # so a student due both reminders gets them 10-day first. Only delivered reminders get their flag.
+    by_chat: Dict[Union[int, str], List[int]] = {}
+    for i, (chat_id, _, _) in enumerate(outbox):
+        by_chat.setdefault(chat_id, []).append(i)
+    results: List[bool] = [False] * len(outbox)
+
+    async def _send_chat(indexes: List[int]) -> None:
+        for i in indexes:
+            chat_id, text, _ = outbox[i]
+            results[i] = await _send_limited(context.bot, chat_id, text)
+
+    await asyncio.gather(*(_send_chat(indexes) for indexes in by_chat.values()))
+    for (_, _, on_sent), ok in zip(outbox, results):
+        if ok and on_sent:
+            sent, key, col_idx, row_num = on_sent
+            sent.add(key)
+            _flag(col_idx, row_num, "TRUE", sent=(sent, key))
+
+    if pending_updates:
+        written = await asyncio.gather(
+            *(_queue_write(u["range"], u["values"]) for u in pending_updates), return_exceptions=True
+        )
+        failed = [res for res in written if isinstance(res, Exception)]
+        for u, res in zip(pending_updates, written):
+            if isinstance(res, Exception):
+                continue
+            if u["sent"]:
+                sent, key = u["sent"]
+                sent.discard(key)
+            if u["sid"]:
+                invalidate_student_cache(u["sid"])
+        if failed:
+            logger.warning("[reminders] Could not write %d flag(s): %s", len(failed), failed[0])
 
 # ===================== Admin-bot helper =====================
 
 async def invite_student_to_subject_groups(bot: Bot, telegram_id: str, subject_keys_lower: List[str]) -> None:
     if not subject_keys_lower:
         return
-    subject_map = fetch_subject_channel_links()
+    subject_map = await _run_sheets(fetch_subject_channel_links)
+
+    # One invite per distinct group (subjects can share one), sent concurrently under the shared send cap.
+    targets: Dict[str, Tuple[str, str]] = {}
     for key in subject_keys_lower:
-        group_id = subject_map.get(key)
-        if not group_id:
-            continue
-        try:
-            chat_id = _chat_id(group_id)
-            invite_link = await bot.create_chat_invite_link(
-                chat_id=chat_id,
-                creates_join_request=True
-            )
-            await bot.send_message(
-                chat_id=int(telegram_id),
-                text=f"رابط الدعوة لمجموعة {key}:\n{invite_link.invite_link}"
-            )
-        except Exception as e:
-            logger.error(f"[invite_student_to_subject_groups] Could not send invite for {key} to {telegram_id}: {e}")
+        if subject_map.get(key):
+            targets.setdefault(_id_str_norm(subject_map[key]), (key, subject_map[key]))
+    await asyncio.gather(*(_deliver_invite(bot, telegram_id, key, group_id) for key, group_id in targets.values()))
 
 # ===== Helper: invite existing subscribed students when a mapping is (re)assigned ====
 
+async def _read_broadcast_roster() -> Optional[Tuple[Dict[str, int], Dict[str, List[object]]]]:
+    """Student columns the broadcast needs; None on failure so it can run alongside the /set write."""
+    try:
+        return await _run_sheets(_read_student_columns, ["id", "subjects", "niveau", "subscription"])
+    except Exception as e:
+        logger.debug("Broadcast roster read failed: %s", e)
+        return None
+
 async def _broadcast_invites_to_existing_students(
     niveau: str,
     subject_canonical: str,
     group_chat_id: Union[int, str],
-    bot: Bot
+    bot: Bot,
+    read: Optional[Tuple[Dict[str, int], Dict[str, List[object]]]]
 ) -> tuple[int, int]:
+    """DM the group's invite link to subscribed students of niveau+subject; `read` is from _read_broadcast_roster()."""
     try:
-        sheets = setup_sheets()
-        res = sheets.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{STUDENT_TABLE_NAME}!A:Z",
-            valueRenderOption="UNFORMATTED_VALUE"
-        ).execute()
-        rows = res.get("values", []) or []
-        if len(rows) < 2:
+        if not read:
             return (0, 0)
 
-        headers = rows[0]
-        id_idx       = _header_index_alias(headers, ["ID"], contains_any=["id"])
-        subjects_idx = _header_index_alias(headers, ["Student Subjects", "Subjects"], contains_any=["subject"])
-        niveau_idx   = _header_index_alias(headers, ["Niveau", "Level"], contains_any=["niveau","level"])
-        subs_idx     = _header_index_alias(headers, ["Subscription"], contains_any=["subscript"])
-
-        if min(id_idx, subjects_idx, niveau_idx, subs_idx) == -1:
+        cols, data = read
+        if min(cols["id"], cols["subjects"], cols["niveau"], cols["subscription"]) == -1:
             return (0, 0)
+        if not data["id"]:
+            return (0, 0)
+        subjects_col, niveau_col, subs_col = data["subjects"], data["niveau"], data["subscription"]
 
         want_level = niveau.strip().lower()
         want_subject = subject_canonical.strip().lower()
 
         try:
-            link_obj = await bot.create_chat_invite_link(chat_id=_chat_id(group_chat_id), creates_join_request=True)
-            invite_url = link_obj.invite_link
+            invite_url = await _invite_link(bot, group_chat_id)
         except Exception as e:
             logger.warning("Failed to create invite link for broadcast: %s", e)
             return (0, 0)
 
-        for row in rows[1:]:
-            if str(_safe_cell(row, subs_idx, "")).strip().upper() != "TRUE":
-                continue
-            if str(_safe_cell(row, niveau_idx, "")).strip().lower() != want_level:
+        # Cheap column filters first; only rows that pass both get their subjects CSV split.
+        recipients: List[str] = []
+        for raw_id, sub_val, niv_val, subjects_csv in zip(data["id"], subs_col, niveau_col, subjects_col):
+            if str(sub_val).strip().upper() != "TRUE" or str(niv_val).strip().lower() != want_level:
                 continue
-            subjects_csv = str(_safe_cell(row, subjects_idx, "") or "")
-            subj_list = [s.strip().lower() for s in subjects_csv.split(",") if s.strip()]
-            if want_subject not in subj_list:
+            if want_subject not in {s.strip().lower() for s in str(subjects_csv or "").split(",")}:
                 continue
+            rid = _id_str_norm(raw_id)
+            if rid:
+                recipients.append(rid)
 
-            rid = _id_str_norm(_safe_cell(row, id_idx, ""))
-            if not rid:
-                continue
-            try:
-                await bot.send_message(
-                    chat_id=_chat_id(rid),
-                    text=f"تم ربط مجموعة جديدة بـ {niveau}_{subject_canonical}.\nرابط الدعوة:\n{invite_url}"
-                )
-            except Exception:
-                pass
-        return (0, 0)
+        text = f"تم ربط مجموعة جديدة بـ {niveau}_{subject_canonical}.\nرابط الدعوة:\n{invite_url}"
+        return await send_to_many(bot, [_chat_id(rid) for rid in recipients], text)
     except Exception as e:
         logger.debug("Broadcast failed: %s", e)
         return (0, 0)
@@ -606,10 +1252,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def view_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id if update.effective_user else None
-    logger.debug(f"[/subjects] Requested by user_id={uid}")
+    logger.debug("[/subjects] Requested by user_id=%s", uid)
     student_id = str(uid)
 
-    info = _get_student_subjects_and_niveau(student_id)
+    info = await _run_sheets(_fetch_student_record, student_id)
     if not info:
         await update.message.reply_text("تعذّر جلب موادك. أعد المحاولة أو تواصل مع المشرف.")
         return
@@ -628,23 +1274,23 @@ async def view_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("مستواك الدراسي غير مسجّل. يرجى التواصل مع المشرف.")
         return
 
-    subject_map = fetch_subject_channel_links()
+    subject_map = await _run_sheets(fetch_subject_channel_links)
+    group_ids = [subject_map.get(_key_for(niveau, subj).lower()) for subj in subjects]
+    links = await asyncio.gather(*(
+        _invite_link(context.bot, gid) for gid in group_ids if gid
+    ), return_exceptions=True)
+    links_iter = iter(links)
     lines: List[str] = []
     had_any_link = False
 
-    for subj in subjects:
-        key = _key_for(niveau, subj).lower()
-        group_id = subject_map.get(key)
+    for subj, group_id in zip(subjects, group_ids):
         if group_id:
-            try:
-                invite_link_obj = await context.bot.create_chat_invite_link(
-                    chat_id=_chat_id(group_id),
-                    creates_join_request=True
-                )
-                lines.append(f"- {subj}: {invite_link_obj.invite_link}")
-                had_any_link = True
-            except Exception:
+            invite_url = next(links_iter)
+            if isinstance(invite_url, Exception):
                 lines.append(f"- {subj}: (تعذّر إنشاء رابط الدعوة)")
+            else:
+                lines.append(f"- {subj}: {invite_url}")
+                had_any_link = True
         else:
             lines.append(f"- {subj}: (لا توجد مجموعة حالياً)")
 
@@ -652,54 +1298,32 @@ async def view_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join([header] + lines))
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    sheets = setup_sheets()
-    result = sheets.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f'{STUDENT_TABLE_NAME}!A:Z',
-        valueRenderOption="UNFORMATTED_VALUE"
-    ).execute()
-    values = result.get('values', []) or []
-
     student_id = str(update.effective_user.id)
-    student_data = None
-    for row_index, row in enumerate(values[1:]):  # Skip header row
-        headers = values[0]
-        id_idx = _header_index_alias(headers, ["ID"], contains_any=["id"])
-        if id_idx == -1:
-            break
-        if row and len(row) > id_idx and _id_str_norm(row[id_idx]) == _id_str_norm(student_id):
-            student_data = row
-            break
-
-    if student_data:
-        headers = values[0]
-        name_idx      = _header_index_alias(headers, ["Student Name", "Name"], contains_any=["name"])
-        pay_idx       = _header_index_alias(headers, ["Payment Method", "Payment"], contains_any=["payment"])
-        reg_idx       = _header_index_alias(headers, ["Register_Date", "Register Date"], contains_all=["register","date"])
-        end_idx       = _header_index_alias(headers, ["End_Date", "End Date"], contains_all=["end","date"])
-
-        subscription_info = f"حالة الاشتراك للطالب { _safe_cell(student_data, name_idx, '') }:\n"
-        subscription_info += f"طريقة الدفع: { _safe_cell(student_data, pay_idx, '') }\n"
-
-        start_date = _safe_cell(student_data, reg_idx, "غير متوفّر")
-        end_date   = _safe_cell(student_data, end_idx, "غير متوفّر")
-
-        subscription_info += f"تاريخ البداية: {start_date}\n"
-        subscription_info += f"تاريخ الانتهاء: {end_date}\n"
-
-        try:
-            if start_date != "غير متوفّر" and end_date != "غير متوفّر":
-                start = datetime.strptime(str(start_date), '%Y-%m-%d').date()
-                end = datetime.strptime(str(end_date), '%Y-%m-%d').date()
-                today = datetime.now().date()
-                if today < start:
-                    subscription_info += "اشتراكك لم يبدأ بعد.\n"
-                elif today > end:
-                    subscription_info += "انتهى اشتراكك.\n"
-                else:
-                    days_left = (end - today).days
-                    subscription_info += f"المدّة المتبقية: {days_left} يوم/أيام.\n"
-        except Exception:
+    record = await _run_sheets(_fetch_student_record, student_id)
+
+    if record:
+        subscription_info = f"حالة الاشتراك للطالب { record['name'] }:\n"
+        subscription_info += f"طريقة الدفع: { record['payment'] }\n"
+
+        start: Optional[date] = record["register"]
+        end: Optional[date] = record["end"]
+
+        def _shown(d: Optional[date], raw: object) -> object:
+            return d.isoformat() if d else (raw if raw not in ("", None) else "غير متوفّر")
+
+        subscription_info += f"تاريخ البداية: {_shown(start, record['register_raw'])}\n"
+        subscription_info += f"تاريخ الانتهاء: {_shown(end, record['end_raw'])}\n"
+
+        if start and end:
+            today = datetime.now().date()
+            if today < start:
+                subscription_info += "اشتراكك لم يبدأ بعد.\n"
+            elif today > end:
+                subscription_info += "انتهى اشتراكك.\n"
+            else:
+                days_left = (end - today).days
+                subscription_info += f"المدّة المتبقية: {days_left} يوم/أيام.\n"
+        elif record["register_raw"] not in ("", None) and record["end_raw"] not in ("", None):
             subscription_info += "(تعذّر تفسير التواريخ)\n"
 
         await update.message.reply_text(subscription_info)
@@ -776,36 +1400,20 @@ async def set_channel_get_subject(update: Update, context: ContextTypes.DEFAULT_
     key_lower = key_canonical.lower()
 
     try:
-        sheets = setup_sheets()
-        res = sheets.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A:B",
-            valueRenderOption="FORMATTED_VALUE",
-        ).execute()
-        values = res.get("values", []) or []
-
-        if not values:
-            sheets.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A1:B1",
-                valueInputOption="RAW",
-                body={"values": [["Subject", "Telegram Group ID"]]},
-            ).execute()
-            values = [["Subject", "Telegram Group ID"]]
+        channels = await _run_sheets(_subject_channels)
 
-        target_row_index = None
-        conflict_key = None
+        if not channels["has_header"]:
+            await _write_cells(f"{SUBJECTS_CHANNEL_TABLE_NAME}!A1:B1", [["Subject", "Telegram Group ID"]])
+            await _run_sheets(invalidate_subject_cache)
 
         chat_id_to_store = str(chat.id)
         chat_id_norm = _id_str_norm(chat.id)
 
-        for i, row in enumerate(values[1:], start=2):
-            cell_key = (row[0].strip().lower() if row and len(row) > 0 and isinstance(row[0], str) else "")
-            cell_gid_norm = _id_str_norm(row[1]) if row and len(row) > 1 else ""
-            if cell_key == key_lower:
-                target_row_index = i
-            if cell_gid_norm and cell_gid_norm == chat_id_norm and cell_key != key_lower:
-                conflict_key = row[0]
+        target_row_index = channels["row_of"].get(key_lower)
+        conflict_key = next(
+            (k for k, _ in reversed(channels["by_gid"].get(chat_id_norm, [])) if k.strip().lower() != key_lower),
+            None
+        )
 
         if conflict_key:
             context.user_data['pending_set'] = {
@@ -818,46 +1426,35 @@ async def set_channel_get_subject(update: Update, context: ContextTypes.DEFAULT_
                  InlineKeyboardButton("إلغاء", callback_data="set_confirm_no")]
             ])
             await update.effective_message.reply_text(
-                f"⚠️ هذه المجموعة معيّنة بالفعل إلى <b>{conflict_key}</b>.\n"
-                f"هل تريد تعيينها إلى <b>{key_canonical}</b> رغم التداخل؟",
+                f"⚠️ هذه المجموعة معيّنة بالفعل إلى <b>{html.escape(conflict_key)}</b>.\n"
+                f"هل تريد تعيينها إلى <b>{html.escape(key_canonical)}</b> رغم التداخل؟",
                 reply_markup=kb,
-                parse_mode="HTML"
+                parse_mode="HTML",
+                disable_web_page_preview=True
             )
             return SET_CONFIRM
 
-        if target_row_index is None:
-            sheets.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A:B",
-                valueInputOption="RAW",
-                insertDataOption="INSERT_ROWS",
-                body={"values": [[key_canonical, chat_id_to_store]]},
-            ).execute()
-            await update.effective_message.reply_text(
-                f"✅ تم إنشاء وربط <b>{key_canonical}</b> بهذه المجموعة.",
-                parse_mode="HTML"
-            )
+        # The broadcast's roster read doesn't depend on the mapping write, so both round trips overlap.
+        appended, roster = await asyncio.gather(
+            _write_subject_mapping(key_canonical, chat_id_to_store, target_row_index),
+            _read_broadcast_roster()
+        )
+        if appended:
+            done_text = f"✅ تم إنشاء وربط <b>{html.escape(key_canonical)}</b> بهذه المجموعة."
         else:
-            sheets.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!B{target_row_index}",
-                valueInputOption="RAW",
-                body={"values": [[chat_id_to_store]]},
-            ).execute()
-            await update.effective_message.reply_text(
-                f"✅ تم تحديث الربط لـ <b>{key_canonical}</b> بهذه المجموعة.",
-                parse_mode="HTML"
-            )
+            done_text = f"✅ تم تحديث الربط لـ <b>{html.escape(key_canonical)}</b> بهذه المجموعة."
+        await update.effective_message.reply_text(done_text, parse_mode="HTML", disable_web_page_preview=True)
 
         try:
             await _broadcast_invites_to_existing_students(
                 niveau=niveau,
                 subject_canonical=key_canonical.split("_", 1)[1],
                 group_chat_id=chat.id,
-                bot=context.bot
+                bot=context.bot,
+                read=roster
             )
         except Exception as e:
-            logger.debug(f"[/set] broadcast invite failed: {e}")
+            logger.debug("[/set] broadcast invite failed: %s", e)
 
     except Exception as e:
         logger.exception("[/set] Exception while setting channel:")
@@ -877,7 +1474,6 @@ async def set_channel_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
     try:
-        sheets = setup_sheets()
         key_canonical = pending['key_canonical']
         target_row_index = pending['target_row_index']
         chat_id_to_store = pending['chat_id_to_store']
@@ -888,29 +1484,15 @@ async def set_channel_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
             await query.edit_message_text("تم الإلغاء.")
             return ConversationHandler.END
 
-        if target_row_index is None:
-            sheets.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!A:B",
-                valueInputOption="RAW",
-                insertDataOption="INSERT_ROWS",
-                body={"values": [[key_canonical, chat_id_to_store]]},
-            ).execute()
-            await query.edit_message_text(
-                f"✅ تم إنشاء وربط <b>{key_canonical}</b> بهذه المجموعة (رغم التداخل).",
-                parse_mode="HTML"
-            )
+        appended, roster = await asyncio.gather(
+            _write_subject_mapping(key_canonical, chat_id_to_store, target_row_index),
+            _read_broadcast_roster()
+        )
+        if appended:
+            done_text = f"✅ تم إنشاء وربط <b>{html.escape(key_canonical)}</b> بهذه المجموعة (رغم التداخل)."
         else:
-            sheets.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SUBJECTS_CHANNEL_TABLE_NAME}!B{target_row_index}",
-                valueInputOption="RAW",
-                body={"values": [[chat_id_to_store]]},
-            ).execute()
-            await query.edit_message_text(
-                f"✅ تم تحديث الربط لـ <b>{key_canonical}</b> بهذه المجموعة (رغم التداخل).",
-                parse_mode="HTML"
-            )
+            done_text = f"✅ تم تحديث الربط لـ <b>{html.escape(key_canonical)}</b> بهذه المجموعة (رغم التداخل)."
+        await query.edit_message_text(done_text, parse_mode="HTML", disable_web_page_preview=True)
 
         try:
             niveau = key_canonical.split("_", 1)[0]
@@ -919,10 +1501,11 @@ async def set_channel_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
                 niveau=niveau,
                 subject_canonical=subj_canon,
                 group_chat_id=query.message.chat.id,
-                bot=context.bot
+                bot=context.bot,
+                read=roster
             )
         except Exception as e:
-            logger.debug(f"[/set_confirm] broadcast invite failed: {e}")
+            logger.debug("[/set_confirm] broadcast invite failed: %s", e)
 
     except Exception as e:
         logger.exception("[/set_confirm] Exception while confirming set:")
@@ -942,7 +1525,7 @@ async def set_channel_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ===================== /register conversation =====================
 
 def _student_exists_by_id(telegram_id: str) -> bool:
-    return _get_student_subjects_and_niveau(telegram_id) is not None
+    return _is_known_student(telegram_id)
 
 def _append_student_row(
     phone: str, name: str, subjects_csv: str, speciality: str, payment: str,
@@ -953,17 +1536,18 @@ def _append_student_row(
         phone, name, subjects_csv, speciality, payment, telegram_id,
         register_date, end_date, "TRUE", "FALSE", "FALSE", niveau
     ]
-    sheets.values().append(
+    _execute(sheets.values().append(
         spreadsheetId=SPREADSHEET_ID,
         range=f"{STUDENT_TABLE_NAME}!A2:L",
         valueInputOption='RAW',
         insertDataOption='INSERT_ROWS',
         body={'values': [row]}
-    ).execute()
+    ), idempotent=False)
+    invalidate_student_cache()
 
 async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    if _student_exists_by_id(uid):
+    if await _run_sheets(_student_exists_by_id, uid):
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("إضافة مادة إلى الإشتراك", callback_data="addsub_start")]])
         await update.message.reply_text("أنت مسجّل مسبقًا.", reply_markup=kb)
         return ConversationHandler.END
@@ -1017,7 +1601,7 @@ def _validate_and_map_labels(input_list: List[str]) -> Tuple[List[str], List[str
       - labels_notes: optional notes like corrections applied
       - invalid_inputs: raw tokens we could not map to allowed labels
     """
-    labels_ok: List[str] = []
+    labels_ok: Dict[str, None] = {}  # insertion-ordered set
     notes: List[str] = []
     invalid: List[str] = []
 
@@ -1026,8 +1610,7 @@ def _validate_and_map_labels(input_list: List[str]) -> Tuple[List[str], List[str
         if not label or label not in ALLOWED_LABELS:
             invalid.append(raw)
             continue
-        if label not in labels_ok:
-            labels_ok.append(label)
+        labels_ok[label] = None
         if reason == "synonym":
             notes.append(f"{raw} → {label}")
         elif reason == "fuzzy":
@@ -1035,7 +1618,7 @@ def _validate_and_map_labels(input_list: List[str]) -> Tuple[List[str], List[str
         elif reason == "combo":
             notes.append(f"{raw} → {label}")
 
-    return labels_ok, notes, invalid
+    return list(labels_ok), notes, invalid
 
 async def reg_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     raw = (update.message.text or "").strip()
@@ -1082,7 +1665,7 @@ async def reg_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['reg']['subjects'] = underlying
 
     # Ensure rows for channels
-    ensure_subject_channels_rows(niveau, underlying)
+    await _run_sheets(ensure_subject_channels_rows, niveau, underlying)
 
     msg = "تم قبول المواد: " + (", ".join(labels_ok) if labels_ok else "—")
     if notes:
@@ -1155,17 +1738,18 @@ async def reg_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     r = context.user_data.get('reg') or {}
-    if _student_exists_by_id(r.get('telegram_id', '')):
+    if await _run_sheets(_student_exists_by_id, r.get('telegram_id', '')):
         await query.edit_message_text("أنت مسجّل مسبقًا.")
         context.user_data.pop('reg', None)
         return ConversationHandler.END
 
     labels_ok: List[str] = r.get('labels', [])
     underlying: List[str] = r.get('subjects', [])
-    ensure_subject_channels_rows(r.get('niveau', ''), underlying)
+    await _run_sheets(ensure_subject_channels_rows, r.get('niveau', ''), underlying)
     subjects_csv = ", ".join(underlying)
 
-    _append_student_row(
+    await _run_sheets(
+        _append_student_row,
         phone=r.get('phone', ''),
         name=r.get('name', ''),
         subjects_csv=subjects_csv,
@@ -1177,32 +1761,23 @@ async def reg_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         niveau=r.get('niveau', '')
     )
 
-    subject_map = fetch_subject_channel_links()
+    subject_map = await _run_sheets(fetch_subject_channel_links)
 
-    # Send invite links where available; compute missing labels
-    missing_labels: List[str] = []
-    sent_any = False
+    # Send invite links where available, one per distinct group (all concurrently); compute missing labels
+    targets: Dict[str, Tuple[str, str, List[str]]] = {}  # gid_norm -> (key shown, gid, labels it serves)
     for label in labels_ok:
-        had_link_for_label = False
         for subj in LABEL_TO_UNDERLYING.get(label, []):
             key = _key_for(r.get('niveau',''), subj).lower()
             gid = subject_map.get(key, "")
             if gid:
-                try:
-                    link = await query.get_bot().create_chat_invite_link(
-                        chat_id=_chat_id(gid),
-                        creates_join_request=True
-                    )
-                    await query.get_bot().send_message(
-                        chat_id=int(r.get('telegram_id', '')),
-                        text=f"رابط الدعوة لمجموعة {key}:\n{link.invite_link}"
-                    )
-                    had_link_for_label = True
-                    sent_any = True
-                except Exception:
-                    pass
-        if not had_link_for_label:
-            missing_labels.append(label)
+                targets.setdefault(_id_str_norm(gid), (key, gid, []))[2].append(label)
+    bot = query.get_bot()
+    results = await asyncio.gather(*(
+        _deliver_invite(bot, r.get('telegram_id', ''), key, gid) for key, gid, _ in targets.values()
+    ))
+    labels_sent = {label for (_, _, labels), ok in zip(targets.values(), results) if ok for label in labels}
+    sent_any = bool(labels_sent)
+    missing_labels: List[str] = [label for label in labels_ok if label not in labels_sent]
 
     msg = "تم تسجيلك بنجاح! " + ("وأُرسلت روابط الدعوة لِمَن توفّر." if sent_any else "")
     if missing_labels:
@@ -1215,19 +1790,39 @@ async def reg_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =============== Add-subject mini flow (when already registered) ===============
 
 def _update_student_subjects_csv(student_id: str, new_csv: str) -> bool:
-    row_num, headers, row = _find_student_row_by_id(student_id)
-    if not row_num:
+    # addsub_start just loaded this record, so its row number is normally a cache hit; a cold
+    # cache falls back to the indexed row read.
+    record = _fetch_student_record(student_id)
+    if not record:
         return False
-    subjects_idx = _header_index_alias(headers, ["Student Subjects", "Subjects"], contains_any=["subject"])
-    if subjects_idx == -1:
+    row_num = record["row_num"]
+    headers, id_idx, _ = _student_index()
+    subjects_idx = _student_cols(headers)["subjects"]
+    if subjects_idx == -1 or id_idx == -1:
         return False
     sheets = setup_sheets()
-    sheets.values().update(
+    # The cached row number may be stale (rows deleted or sorted since): re-read the header and
+    # this row's ID cell in one batchGet, and drop the write if either no longer matches.
+    id_col = _col_letter(id_idx)
+    res = _execute(sheets.values().batchGet(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=[f"{STUDENT_TABLE_NAME}!A1:Z1", f"{STUDENT_TABLE_NAME}!{id_col}{row_num}"],
+        valueRenderOption="UNFORMATTED_VALUE",
+        majorDimension="COLUMNS"
+    ))
+    value_ranges = res.get("valueRanges", []) or []
+    id_vals = (value_ranges[1].get("values") or [[]])[0] if len(value_ranges) > 1 else []
+    if (_header_row(value_ranges[0] if value_ranges else {}) != list(headers)
+            or _id_str_norm(id_vals[0] if id_vals else "") != _id_str_norm(student_id)):
+        invalidate_student_cache()
+        return False
+    _execute(sheets.values().update(
         spreadsheetId=SPREADSHEET_ID,
         range=f"{STUDENT_TABLE_NAME}!{_col_letter(subjects_idx)}{row_num}",
         valueInputOption="RAW",
         body={"values": [[new_csv]]}
-    ).execute()
+    ))
+    invalidate_student_cache(student_id)
     return True
 
 async def addsub_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1236,7 +1831,7 @@ async def addsub_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = str(query.from_user.id)
 
-    info = _get_student_subjects_and_niveau(uid)
+    info = await _run_sheets(_fetch_student_record, uid)
     if not info:
         await query.edit_message_text("تعذّر العثور على حسابك. حاول /register.")
         return ConversationHandler.END
@@ -1299,30 +1894,23 @@ async def addsub_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Update sheet
     csv_val = ", ".join(new_underlying)
-    if not _update_student_subjects_csv(uid, csv_val):
+    if not await _run_sheets(_update_student_subjects_csv, uid, csv_val):
         await update.message.reply_text("تعذّر تحديث موادك. حاول لاحقًا.")
         return ConversationHandler.END
 
     # Ensure channels rows & send invites where available
-    ensure_subject_channels_rows(niveau, underlying_to_add)
-    subject_map = fetch_subject_channel_links()
-    had_link_for_label = False
+    await _run_sheets(ensure_subject_channels_rows, niveau, underlying_to_add)
+    subject_map = await _run_sheets(fetch_subject_channel_links)
+    targets: Dict[str, Tuple[str, str]] = {}  # gid_norm -> (key shown, gid): one invite per group
     for s in underlying_to_add:
         key = _key_for(niveau, s).lower()
         gid = subject_map.get(key, "")
         if gid:
-            try:
-                link = await context.bot.create_chat_invite_link(
-                    chat_id=_chat_id(gid),
-                    creates_join_request=True
-                )
-                await context.bot.send_message(
-                    chat_id=int(uid),
-                    text=f"رابط الدعوة لمجموعة {key}:\n{link.invite_link}"
-                )
-                had_link_for_label = True
-            except Exception:
-                pass
+            targets.setdefault(_id_str_norm(gid), (key, gid))
+    results = await asyncio.gather(*(
+        _deliver_invite(context.bot, uid, key, gid) for key, gid in targets.values()
+    ))
+    had_link_for_label = any(results)
 
     msg = f"تمت إضافة المادة إلى اشتراكك: {label}."
     if not had_link_for_label:
@@ -1348,14 +1936,14 @@ def main(updater_none: bool = False):
         entry_points=[CommandHandler("set", set_channel_start, filters=(filters.ChatType.GROUPS & ~filters.SenderChat()))],
         states={
             SET_NIVEAU: [
-                CallbackQueryHandler(set_channel_get_niveau, pattern=r"^setniv:"),
+                CallbackQueryHandler(set_channel_get_niveau, pattern=_RE_SETNIV),
                 MessageHandler(filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, set_channel_get_niveau),
             ],
             SET_SUBJECT: [
                 MessageHandler(filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, set_channel_get_subject),
-                CallbackQueryHandler(set_channel_confirm, pattern=r"^set_confirm_(yes|no)$"),
+                CallbackQueryHandler(set_channel_confirm, pattern=_RE_SET_CONFIRM),
             ],
-            SET_CONFIRM: [CallbackQueryHandler(set_channel_confirm, pattern=r"^set_confirm_(yes|no)$")],
+            SET_CONFIRM: [CallbackQueryHandler(set_channel_confirm, pattern=_RE_SET_CONFIRM)],
         },
         fallbacks=[CommandHandler("cancel", set_channel_cancel, filters=filters.ChatType.GROUPS)],
         allow_reentry=True,
@@ -1369,14 +1957,14 @@ def main(updater_none: bool = False):
             REG_NAME:       [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_name)],
             REG_PHONE:      [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_phone)],
             REG_NIVEAU:     [
-                CallbackQueryHandler(reg_niveau, pattern=r"^niv:"),
+                CallbackQueryHandler(reg_niveau, pattern=_RE_REG_NIVEAU),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, reg_niveau)
             ],
             REG_SUBJECTS:   [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_subjects)],
             REG_SPECIALITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_speciality)],
             REG_PAYMENT:    [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_payment)],
             REG_PERIOD:     [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_period)],
-            REG_CONFIRM:    [CallbackQueryHandler(reg_confirm, pattern=r"^reg_(yes|no)$")],
+            REG_CONFIRM:    [CallbackQueryHandler(reg_confirm, pattern=_RE_REG_CONFIRM)],
         },
         fallbacks=[CommandHandler("cancel", set_channel_cancel)],
         allow_reentry=True,
@@ -1385,7 +1973,7 @@ def main(updater_none: bool = False):
 
     # Add-subject mini conversation
     addsub_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(addsub_start, pattern=r"^addsub_start$")],
+        entry_points=[CallbackQueryHandler(addsub_start, pattern=_RE_ADDSUB_START)],
         states={ADD_SUBJECT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, addsub_receive)]},
         fallbacks=[CommandHandler("cancel", set_channel_cancel)],
         allow_reentry=True,
@@ -1406,25 +1994,25 @@ def main(updater_none: bool = False):
     return application
 
 # --- Optional warm-up for Render cold starts ---------------------------------
-import asyncio
+
+# main.py fires a prewarm for every webhook that lands before the apps are ready;
+# calls made while one is in flight wait on it instead of starting another.
+_PREWARM_TASK: Optional[asyncio.Task] = None
+
+async def _prewarm() -> None:
+    results = await asyncio.gather(
+        _run_sheets(_student_index), _run_sheets(_subject_channels), return_exceptions=True
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            logger.warning("[prewarm_clients] Warm-up skipped/failed: %s", res)
 
 async def prewarm_clients():
     """
-    Lazily mint Google credentials and do a tiny Sheets read so the first
-    real webhook doesn’t pay the cold-start cost. Safe to call multiple times.
+    Mint Google credentials and fill the Students ID index and the Subjects_Channels
+    map, so the first real webhook finds them cached. Safe to call multiple times.
     """
-    def _sync():
-        try:
-            creds = _load_gcp_credentials()
-            service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-            rng = f"{STUDENT_TABLE_NAME}!A1:A1"
-            service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=rng
-            ).execute()
-        except Exception as e:
-            logger.warning("[prewarm_clients] Warm-up skipped/failed: %s", e)
-
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _sync)
-
+    global _PREWARM_TASK
+    if _PREWARM_TASK is None or _PREWARM_TASK.done():
+        _PREWARM_TASK = asyncio.ensure_future(_prewarm())
+    await asyncio.shield(_PREWARM_TASK)